@@ -7,6 +7,7 @@ import asyncio
 from collections import defaultdict
 import aiohttp
 import json
+from shared.extractor import EXTRACTOR
 
 COOLDOWN = 15
 
@@ -135,7 +136,7 @@ async def _delayed_send(channel_id):
     await asyncio.sleep(COOLDOWN)
     await send_pending_events(channel_id)
 
-def get_stream_info(url_or_query: str):
+async def get_stream_info(url_or_query: str):
     """Extrai informações de áudio (stream_url, título, etc)"""
     ydl_opts = {
         'format': 'bestaudio/best[ext!=webm]/best[ext!=webm]/bestaudio/best/best',
@@ -144,20 +145,16 @@ def get_stream_info(url_or_query: str):
         'extractaudio': False,
     }
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url_or_query, download=False)
-            return info
+        # yt-dlp runs in the shared worker pool, so a slow link cannot stall the gateway
+        return await EXTRACTOR.extract_info(url_or_query, ydl_opts)
     except yt_dlp.DownloadError as e:
         if "Requested format is not available" in str(e) or "format" in str(e).lower():
             # If the preferred format is not available, try with a more flexible format
             ydl_opts_alt = ydl_opts.copy()
             ydl_opts_alt["format"] = "bestaudio/best/best[ext!=webm]/best"
-            with yt_dlp.YoutubeDL(ydl_opts_alt) as ydl:
-                info = ydl.extract_info(url_or_query, download=False)
-                return info
+            return await EXTRACTOR.extract_info(url_or_query, ydl_opts_alt)
         else:
             raise e
-    return info
 
 
 async def play_next(ctx):
@@ -239,11 +236,11 @@ async def play(ctx, *, query: str):
         print(f"🔎 Procurando: {query}")
         # Se não for link, busca no YouTube
         if not query.startswith("http"):
-            info = get_stream_info(f"ytsearch1:{query}")
+            info = await get_stream_info(f"ytsearch1:{query}")
             if "entries" in info:
                 info = info["entries"][0]
         else:
-            info = get_stream_info(query)
+            info = await get_stream_info(query)
 
         # Se for playlist
         if "_type" in info and info["_type"] == "playlist":
@@ -251,7 +248,7 @@ async def play(ctx, *, query: str):
             songs_added = 0
             for entry in info["entries"]:
                 try:
-                    full = get_stream_info(entry["url"])
+                    full = await get_stream_info(entry["url"])
                     queues[ctx.guild.id].append({
                         "title": full.get("title", "Unknown Title"),
                         "stream_url": full["url"],
@@ -385,4 +382,6 @@ if __name__ == "__main__":
     if TOKEN is None:
         print("Error: DISCORD_TOKEN not found in environment variables")
     else:
+        # Fork the yt-dlp workers before discord.py starts its threads
+        EXTRACTOR.start()
         bot.run(TOKEN)
\ No newline at end of file
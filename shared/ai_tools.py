@@ -1,6 +1,14 @@
+import asyncio
+import functools
+import hashlib
 import os
+import queue
+import threading
 import time
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from groq import Groq
 from dotenv import load_dotenv
 from serpapi import GoogleSearch
@@ -8,11 +16,122 @@ from random import randint
 from openai import OpenAI  # Keep for LM Studio
 from zai import ZaiClient  # Official z.ai SDK
 import base64
+import contextvars
 import requests
 import re
+from shared.cache import RESPONSE_CACHE, AI_MEDIA_CACHE_TTL
+from shared.ratelimit import RATE_LIMITS, QuotaExceeded, estimate_tokens
+from shared import audio as audio_tools
 
 load_dotenv()
 
+# The provider SDKs are blocking; async callers run them on this pool so a
+# slow model call never stalls the bot's event loop
+AI_MAX_WORKERS = int(os.getenv("AI_MAX_WORKERS", 8))
+AI_EXECUTOR = ThreadPoolExecutor(max_workers=AI_MAX_WORKERS, thread_name_prefix="ai")
+
+# Seconds an async caller waits for a model answer / a transcription
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", 60))
+TRANSCRIBE_TIMEOUT = float(os.getenv("TRANSCRIBE_TIMEOUT", 300))
+
+# Chunks of a long recording are uploaded in parallel from this pool; the
+# rate limiter decides how many of them actually run at once
+TRANSCRIBE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("TRANSCRIBE_WORKERS", 4)),
+                                         thread_name_prefix="transcribe")
+
+
+async def run_blocking(fn, *args, timeout: float = AI_TIMEOUT, **kwargs):
+    """
+    Run a blocking provider call on AI_EXECUTOR and await its result.
+
+    Raises asyncio.TimeoutError after timeout seconds. On timeout or
+    cancellation the caller is released right away; the worker thread
+    finishes the HTTP request (bounded by the client's own timeout) and
+    its result is discarded.
+    """
+    loop = asyncio.get_running_loop()
+    # Copy the caller's context so its request_priority() reaches the worker
+    context = contextvars.copy_context()
+    future = loop.run_in_executor(AI_EXECUTOR, functools.partial(context.run, fn, *args, **kwargs))
+    return await asyncio.wait_for(future, timeout)
+
+
+async def stream_blocking(fn, *args, timeout: float = AI_TIMEOUT, **kwargs):
+    """
+    Iterate a blocking generator (a provider's chat_stream) from async code.
+
+    The generator runs on AI_EXECUTOR and hands each chunk to the event loop
+    as soon as it arrives. Raises asyncio.TimeoutError when no chunk arrives
+    within timeout seconds. Leaving the loop early stops the generator at
+    its next chunk.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    stop = threading.Event()
+
+    def deliver(item):
+        try:
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+        except RuntimeError:  # event loop already closed
+            stop.set()
+
+    def produce():
+        generator = fn(*args, **kwargs)
+        try:
+            for chunk in generator:
+                if stop.is_set():
+                    break
+                deliver(("chunk", chunk))
+            deliver(("done", None))
+        except Exception as e:
+            deliver(("error", e))
+        finally:
+            generator.close()
+
+    loop.run_in_executor(AI_EXECUTOR, contextvars.copy_context().run, produce)
+    try:
+        while True:
+            kind, item = await asyncio.wait_for(chunks.get(), timeout)
+            if kind == "done":
+                return
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class ProviderUnavailable(Exception):
+    """A provider turned a request down without trying it (rate-limit window, open circuit)."""
+
+
+def media_id(file_unique_id: str) -> str:
+    """Cache stand-in for a Telegram file's content, usable before it is downloaded."""
+    return f"telegram:{file_unique_id}"
+
+
+def download_image_as_base64(image_url: str) -> str:
+    """Baixa a imagem de uma URL e retorna como data URL em base64."""
+    try:
+        response = requests.get(image_url, timeout=10)
+        response.raise_for_status()
+        image_base64 = base64.b64encode(response.content).decode('utf-8')
+
+        # Detect content type from response or default to jpeg
+        content_type = response.headers.get('Content-Type', 'image/jpeg')
+        if content_type.startswith('image/'):
+            content_type = content_type.split('/')[1]
+
+        return f"data:image/{content_type};base64,{image_base64}"
+    except Exception as e:
+        logging.error(f"Erro ao baixar imagem: {e}")
+        raise
+
+
+def system_and_prompt(messages) -> str:
+    """The text of a chat request, for token estimates."""
+    return "".join(message["content"] for message in messages if isinstance(message["content"], str))
+
 
 def remove_think_tags(text: str) -> str:
     """
@@ -26,33 +145,11 @@ def remove_think_tags(text: str) -> str:
 
 class Z_Ai:
     def __init__(self):
-        self.client = ZaiClient(api_key=os.getenv("Z_AI_API_KEY"))
+        self.client = ZaiClient(api_key=os.getenv("Z_AI_API_KEY"), timeout=AI_TIMEOUT)
         self.chat_model = "glm-4.6"
         self.vision_model = "glm-4.6v"
 
-    def _download_image_as_base64(self, image_url: str) -> str:
-        """Baixa a imagem de uma URL e retorna como base64."""
-        try:
-            response = requests.get(image_url, timeout=10)
-            response.raise_for_status()
-            image_base64 = base64.b64encode(response.content).decode('utf-8')
-
-            # Detect content type from response or default to jpeg
-            content_type = response.headers.get('Content-Type', 'image/jpeg')
-            if content_type.startswith('image/'):
-                content_type = content_type.split('/')[1]
-
-            return f"data:image/{content_type};base64,{image_base64}"
-        except Exception as e:
-            logging.error(f"Erro ao baixar imagem: {e}")
-            raise
-
-    def chat(self, mensagem_usuario, historico=None, image_url=None, image_base64=None):
-        """
-        Envia uma mensagem para a API e retorna a resposta.
-        Se image_url for fornecido, baixa a imagem e converte para base64.
-        Se image_base64 for fornecido, usa diretamente.
-        """
+    def _base_messages(self, historico=None):
         messages = [
             {
                 "role": "system",
@@ -62,17 +159,59 @@ class Z_Ai:
 
         if historico:
             messages.extend(historico)
+        return messages
+
+    def _cache_key(self, mensagem_usuario, historico, image=None):
+        model = self.vision_model if image else self.chat_model
+        messages = self._base_messages(historico) + [{"role": "user", "content": mensagem_usuario}]
+        return RESPONSE_CACHE.make_key("z_ai", model, messages, 0.7, image)
+
+    def cached_chat(self, mensagem_usuario, historico=None, image_id=None):
+        """
+        Resposta já em cache para a pergunta, sem baixar nada.
+        image_id é o file_unique_id da imagem do Telegram, se houver.
+        """
+        image = media_id(image_id) if image_id else None
+        return RESPONSE_CACHE.get(self._cache_key(mensagem_usuario, historico, image))
+
+    async def acached_chat(self, mensagem_usuario, historico=None, image_id=None):
+        """Async version of cached_chat(), run on the AI thread pool."""
+        return await run_blocking(self.cached_chat, mensagem_usuario, historico, image_id)
+
+    def _prepare(self, mensagem_usuario, historico, image_url, image_base64, use_cache, image_id):
+        """
+        Monta a requisição de chat() / chat_stream().
+        Retorna (resposta em cache ou None, modelo, mensagens, chaves de cache, ttl).
+        """
+        messages = self._base_messages(historico)
+
+        has_image = bool(image_url or image_base64)
+        cache_keys = []
+        if has_image and image_id:
+            cache_keys.append(self._cache_key(mensagem_usuario, historico, media_id(image_id)))
+            if use_cache:
+                cached = RESPONSE_CACHE.get(cache_keys[0])
+                if cached is not None:
+                    return cached, None, None, None, None
 
         # Process image: if URL provided, download and convert to base64
         processed_image = None
         if image_url and not image_base64:
-            processed_image = self._download_image_as_base64(image_url)
+            processed_image = download_image_as_base64(image_url)
         elif image_base64:
             processed_image = image_base64
 
         # Seleciona o modelo baseado na presença de imagem
         model = self.vision_model if processed_image else self.chat_model
 
+        cache_keys.append(self._cache_key(mensagem_usuario, historico, processed_image))
+        cache_ttl = AI_MEDIA_CACHE_TTL if processed_image else None
+        if use_cache:
+            cached = RESPONSE_CACHE.get(cache_keys[-1])
+            if cached is not None:
+                RESPONSE_CACHE.set_all(cache_keys[:-1], cached, cache_ttl)
+                return cached, None, None, None, None
+
         # Formata o conteúdo da mensagem
         if processed_image:
             content = [
@@ -88,72 +227,347 @@ class Z_Ai:
             content = mensagem_usuario
 
         messages.append({"role": "user", "content": content})
+        return None, model, messages, cache_keys, cache_ttl
+
+    def chat(self, mensagem_usuario, historico=None, image_url=None, image_base64=None, use_cache=True,
+             image_id=None, raise_errors=False):
+        """
+        Envia uma mensagem para a API e retorna a resposta.
+        Se image_url for fornecido, baixa a imagem e converte para base64.
+        Se image_base64 for fornecido, usa diretamente.
+        Respostas repetidas vêm do RESPONSE_CACHE, a menos que use_cache seja False.
+        Com image_id (file_unique_id do Telegram) o cache é consultado antes do download.
+        Com raise_errors os erros da API sobem em vez de virar a resposta.
+        """
+        cached, model, messages, cache_keys, cache_ttl = self._prepare(
+            mensagem_usuario, historico, image_url, image_base64, use_cache, image_id
+        )
+        if cached is not None:
+            return cached
 
         try:
+            RATE_LIMITS.acquire("z_ai", model)
             response = self.client.chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=0.7
             )
 
-            return response.choices[0].message.content
+            answer = response.choices[0].message.content
+            RESPONSE_CACHE.set_all(cache_keys, answer, cache_ttl)
+            return answer
 
         except Exception as e:
+            if raise_errors:
+                raise
             return f"Erro ao chamar a API: {e}"
 
+    async def achat(self, mensagem_usuario, historico=None, image_url=None, image_base64=None, use_cache=True,
+                    image_id=None, timeout=AI_TIMEOUT):
+        """Async version of chat(), run on the AI thread pool."""
+        return await run_blocking(self.chat, mensagem_usuario, historico, image_url, image_base64, use_cache,
+                                  image_id, timeout=timeout)
+
+    def chat_stream(self, mensagem_usuario, historico=None, image_url=None, image_base64=None, use_cache=True,
+                    image_id=None, raise_errors=False):
+        """
+        Igual a chat(), mas gera a resposta em pedaços conforme o modelo escreve.
+        Uma resposta em cache sai inteira de uma vez; só respostas completas vão para o cache.
+        """
+        cached, model, messages, cache_keys, cache_ttl = self._prepare(
+            mensagem_usuario, historico, image_url, image_base64, use_cache, image_id
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        try:
+            RATE_LIMITS.acquire("z_ai", model)
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                stream=True
+            )
+            for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            if raise_errors:
+                raise
+            if parts:
+                logging.error(f"Erro no meio do streaming: {e}")
+            else:
+                yield f"Erro ao chamar a API: {e}"
+            return
+
+        RESPONSE_CACHE.set_all(cache_keys, "".join(parts), cache_ttl)
+
+    def astream_chat(self, mensagem_usuario, historico=None, image_url=None, image_base64=None, use_cache=True,
+                     image_id=None, timeout=AI_TIMEOUT):
+        """Async iterator over chat_stream(), run on the AI thread pool."""
+        return stream_blocking(self.chat_stream, mensagem_usuario, historico, image_url, image_base64, use_cache,
+                               image_id, timeout=timeout)
+
 
 class GroqAPI:
     def __init__(self):
-        self.client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+        self.client = Groq(api_key=os.getenv("GROQ_API_KEY"), timeout=TRANSCRIBE_TIMEOUT)
         self.free_whispers_models = ["whisper-large-v3", "distil-whisper-large-v3-en", "whisper-large-v3-turbo"]
-        self.last_chat_call_time = 0
+        self.chat_model = "llama-3.3-8b-instant"
+        self.vision_model = "meta-llama/llama-4-scout-17b-16e-instruct"
 
-    def chat(self, prompt):
-        current_time = time.time()
-        time_since_last_call = current_time - self.last_chat_call_time
+    def _acquire(self, model, tokens, wait=True):
+        """
+        Wait for quota in the shared rate limiter; ProviderUnavailable if it does not free up in time.
 
-        if time_since_last_call < 30:
-            return "Espera ai brota, aqui tem limite pq eh de gratis"
+        With wait=False the quota is only taken if it is free right now,
+        and a busy model counts as skipped rather than timed out.
+        """
+        if not wait:
+            if not RATE_LIMITS.try_acquire("groq", model, tokens):
+                raise ProviderUnavailable(f"groq/{model}: quota in use")
+            return
+        try:
+            RATE_LIMITS.acquire("groq", model, tokens)
+        except QuotaExceeded as e:
+            raise ProviderUnavailable(str(e)) from e
 
-        self.last_chat_call_time = time.time()
+    def _prepare_chat(self, prompt, use_cache):
+        """
+        Build the chat request. Returns (cached answer, messages, cache key);
+        a cached answer means no call is needed.
+        """
         system = "Você é uma IA em um grupo de amigos que responde perguntas de forma clara e concisa. Responda na linguagem que for perguntado e em html"
+        messages = [
+            {
+                "role": "system",
+                "content": f"{system}"
+            },
+            {
+                "role": "user",
+                "content": f"{prompt}"
+            }
+        ]
+        # Cached answers cost no quota
+        cache_key = RESPONSE_CACHE.make_key("groq", self.chat_model, messages, 1)
+        if use_cache:
+            cached = RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                return cached, None, None
+        return None, messages, cache_key
+
+    def chat(self, prompt, use_cache=True, raise_errors=False):
+        """
+        Answer prompt, waiting in the rate limiter's queue for quota first.
+        Without raise_errors, errors and a queue timeout return the usual
+        "Espera ai brota" notice.
+        """
+        cached, messages, cache_key = self._prepare_chat(prompt, use_cache)
+        if cached is not None:
+            return cached
+
+        estimated = estimate_tokens(system_and_prompt(messages))
         try:
+            self._acquire(self.chat_model, estimated)
             completion = self.client.chat.completions.create(
-                model="llama-3.3-8b-instant",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"{system}"
-                    },
-                    {
-                        "role": "user",
-                        "content": f"{prompt}"
-                    }
-                ],
+                model=self.chat_model,
+                messages=messages,
                 temperature=1,
                 top_p=1,
                 stream=False,
             )
-            return completion.choices[0].message.content
-        except:
+            RATE_LIMITS.record_usage("groq", self.chat_model, estimated, completion.usage.total_tokens)
+            answer = completion.choices[0].message.content
+            RESPONSE_CACHE.set(cache_key, answer)
+            return answer
+        except Exception:
+            if raise_errors:
+                raise
             return "Espera ai brota, aqui tem limite pq eh de gratis"
 
-    def transcribe_audio(self, filename):
-        for model in self.free_whispers_models:
+    async def achat(self, prompt, use_cache=True, timeout=AI_TIMEOUT):
+        """Async version of chat(), run on the AI thread pool."""
+        return await run_blocking(self.chat, prompt, use_cache, timeout=timeout)
+
+    def chat_stream(self, prompt, use_cache=True, raise_errors=False):
+        """Like chat(), but yields the answer in pieces as the model writes it."""
+        cached, messages, cache_key = self._prepare_chat(prompt, use_cache)
+        if cached is not None:
+            yield cached
+            return
+
+        estimated = estimate_tokens(system_and_prompt(messages))
+        used = None
+        parts = []
+        try:
+            self._acquire(self.chat_model, estimated)
+            completion = self.client.chat.completions.create(
+                model=self.chat_model,
+                messages=messages,
+                temperature=1,
+                top_p=1,
+                stream=True,
+            )
+            for chunk in completion:
+                # Groq reports the usage on the last chunk
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None):
+                    used = x_groq.usage.total_tokens
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            if raise_errors:
+                raise
+            if parts:
+                logging.error(f"Groq stream interrupted: {e}")
+            else:
+                yield "Espera ai brota, aqui tem limite pq eh de gratis"
+            return
+
+        answer = "".join(parts)
+        if used is None:
+            used = estimate_tokens(system_and_prompt(messages), completion=len(answer) // 4)
+        RATE_LIMITS.record_usage("groq", self.chat_model, estimated, used)
+        RESPONSE_CACHE.set(cache_key, answer)
+
+    def astream_chat(self, prompt, use_cache=True, timeout=AI_TIMEOUT):
+        """Async iterator over chat_stream(), run on the AI thread pool."""
+        return stream_blocking(self.chat_stream, prompt, use_cache, timeout=timeout)
+
+    def _transcription_key(self, audio):
+        return RESPONSE_CACHE.make_key("groq", "transcription", None, None, audio)
+
+    def cached_transcription(self, file_unique_id):
+        """Transcription already cached for a Telegram file, looked up without downloading it."""
+        return RESPONSE_CACHE.get(self._transcription_key(media_id(file_unique_id)))
+
+    async def acached_transcription(self, file_unique_id):
+        """Async version of cached_transcription(), run on the AI thread pool."""
+        return await run_blocking(self.cached_transcription, file_unique_id)
+
+    def _content_key(self, audio):
+        """Transcription cache key of a recording, the same whether it is given as bytes or as a file path."""
+        if isinstance(audio, str):
+            digest = hashlib.sha256()
+            with open(audio, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+        else:
+            digest = hashlib.sha256(audio)
+        return self._transcription_key(f"sha256:{digest.hexdigest()}")
+
+    def transcribe_audio(self, audio, file_unique_id=None, use_cache=True, filename=None):
+        """
+        Transcribe a recording, given as bytes or as a file path, trying each free Whisper model in turn.
+
+        The audio is first compressed to 16 kHz mono Opus with silence trimmed
+        (audio_tools.prepare), in memory. Recordings longer than
+        audio_tools.CHUNK_SECONDS (or too large for one upload) are cut at
+        silences and the chunks transcribed in parallel. filename only names
+        the upload; it defaults to the path's name.
+        Results are cached by the content hash and, when given, by the
+        Telegram file_unique_id, so reposted or forwarded media is free.
+        """
+        if isinstance(audio, str):
+            filename = filename or os.path.basename(audio)
+        filename = filename or "audio"
+
+        cache_keys = [self._content_key(audio)]
+        if file_unique_id:
+            cache_keys.append(self._transcription_key(media_id(file_unique_id)))
+        if use_cache:
+            cached = RESPONSE_CACHE.get_any(cache_keys, AI_MEDIA_CACHE_TTL)
+            if cached is not None:
+                return cached
+
+        # Upload 16 kHz mono speech instead of whatever the file holds
+        base = os.path.splitext(filename)[0]
+        prepared = audio_tools.prepare(audio)
+        if prepared is None:
+            if isinstance(audio, str):
+                with open(audio, "rb") as file:
+                    audio = file.read()
+            text = self._transcribe_piece(filename, audio)
+        else:
+            compressed, chunks = prepared
+            if chunks is None:
+                text = self._transcribe_piece(f"{base}.{audio_tools.CHUNK_EXTENSION}", compressed)
+            else:
+                text = self._transcribe_chunks(base, compressed, chunks)
+        RESPONSE_CACHE.set_all(cache_keys, text, AI_MEDIA_CACHE_TTL)
+        return text
+
+    def _transcribe_piece(self, filename, audio):
+        """
+        Transcribe one upload, failing over through free_whispers_models.
+
+        A model whose quota is used up is skipped rather than waited for;
+        only when every one is exhausted does the first one get waited on.
+        """
+        for attempt, model in enumerate(self.free_whispers_models + self.free_whispers_models[:1]):
+            waiting = attempt == len(self.free_whispers_models)
+            try:
+                self._acquire(model, 0, wait=waiting)
+            except ProviderUnavailable as e:
+                if waiting:
+                    logging.error(f"Transcription with {model} failed: {e}")
+                else:
+                    logging.info(f"Skipping {model} for transcription: {e}")
+                continue
             try:
-                with open(filename, "rb") as file:
-                    transcription = self.client.audio.transcriptions.create(
-                        file=(filename, file.read()),
-                        model=model,
-                        response_format="verbose_json",
-                    )
-                    return transcription.text
+                transcription = self.client.audio.transcriptions.create(
+                    file=(filename, audio),
+                    model=model,
+                    response_format="verbose_json",
+                )
+                return transcription.text
             except Exception as e:
+                logging.error(f"Transcription with {model} failed: {e}")
                 continue
 
         raise Exception("No transcription available")
 
-    def vision(self, prompt, base64_image):
+    def _transcribe_chunks(self, base, audio, chunks):
+        """
+        Transcribe the (start, end) chunks of a long recording in parallel and join them in order.
+
+        Each chunk fails over on its own, so one bad upload only repeats that chunk.
+        """
+        def transcribe_chunk(index, start, end):
+            piece = audio_tools.extract(audio, start, end)
+            return self._transcribe_piece(f"{base}-{index}.{audio_tools.CHUNK_EXTENSION}", piece)
+
+        logging.info(f"Transcribing {base} in {len(chunks)} chunks")
+        futures = [
+            TRANSCRIBE_EXECUTOR.submit(contextvars.copy_context().run, transcribe_chunk, index, start, end)
+            for index, (start, end) in enumerate(chunks)
+        ]
+        try:
+            return " ".join(future.result().strip() for future in futures)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def atranscribe_audio(self, audio, file_unique_id=None, use_cache=True, filename=None,
+                                timeout=TRANSCRIBE_TIMEOUT):
+        """Async version of transcribe_audio(), run on the AI thread pool."""
+        return await run_blocking(self.transcribe_audio, audio, file_unique_id, use_cache, filename, timeout=timeout)
+
+    def vision(self, prompt, base64_image, use_cache=True):
+        cache_key = RESPONSE_CACHE.make_key("groq", self.vision_model, prompt, None, base64_image)
+        if use_cache:
+            cached = RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
+        estimated = estimate_tokens(prompt)
+        self._acquire(self.vision_model, estimated)
         chat_completion = self.client.chat.completions.create(
             messages=[
                 {
@@ -169,9 +583,16 @@ class GroqAPI:
                     ],
                 }
             ],
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
+            model=self.vision_model,
         )
-        return chat_completion.choices[0].message.content
+        RATE_LIMITS.record_usage("groq", self.vision_model, estimated, chat_completion.usage.total_tokens)
+        answer = chat_completion.choices[0].message.content
+        RESPONSE_CACHE.set(cache_key, answer, AI_MEDIA_CACHE_TTL)
+        return answer
+
+    async def avision(self, prompt, base64_image, use_cache=True, timeout=AI_TIMEOUT):
+        """Async version of vision(), run on the AI thread pool."""
+        return await run_blocking(self.vision, prompt, base64_image, use_cache, timeout=timeout)
 
 class GoogleSearchAPI:
     def __init__(self):
@@ -192,43 +613,78 @@ class GoogleSearchAPI:
                 return images[random_number]
         return ""
 
+    async def aget_image(self, text: str, timeout=AI_TIMEOUT) -> str:
+        """Async version of get_image(), run on the AI thread pool."""
+        return await run_blocking(self.get_image, text, timeout=timeout)
+
 
 class LMStudioAPI:
     def __init__(self):
-        self.client = OpenAI(api_key="", base_url="http://192.168.1.225:1234/v1")
+        self.base_url = os.getenv("LM_STUDIO_URL", "http://192.168.1.225:1234/v1")
+        self.client = OpenAI(api_key="", base_url=self.base_url, timeout=AI_TIMEOUT)
         self.model = "grok-3-reasoning-gemma3-12b-distilled-hf"
 
-    def is_avaiable(self):
-        return False
+    def is_avaiable(self, timeout=2):
+        """Health probe: the server answers and has our model loaded."""
+        try:
+            response = requests.get(f"{self.base_url}/models", timeout=timeout)
+            response.raise_for_status()
+            return any(model.get("id") == self.model for model in response.json().get("data", []))
+        except Exception:
+            return False
 
-    def chat(self, prompt):
+    def chat(self, prompt, use_cache=True):
         system="""
         Você é uma IA em um grupo de amigos que responde perguntas de forma clara e concisa.
         Seja ácido e raivoso sempre que possível, seja hostil e ofensivo.
         Responda na linguagem que for perguntado e não utilize tags html
         """
+        messages = [
+            {
+                'role': 'system',
+                'content': system,
+            },
+            {
+                'role': 'user',
+                'content': prompt,
+            },
+        ]
+        cache_key = RESPONSE_CACHE.make_key("lm_studio", self.model, messages, 0.7)
+        if use_cache:
+            cached = RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
                 temperature=0.7,
                 max_tokens=-1,
                 stream=False,
-                messages=[
-                    {
-                        'role': 'system',
-                        'content': system,
-                    },
-                    {
-                        'role': 'user',
-                        'content': prompt,
-                    },
-                ]
+                messages=messages
             )
-            return remove_think_tags(response.choices[0].message.content)
+            answer = remove_think_tags(response.choices[0].message.content)
+            RESPONSE_CACHE.set(cache_key, answer)
+            return answer
         except Exception as e:
-            import time
-            time.sleep(20)
-            raise e
+            logging.error(f"LM Studio error: {e}")
+            raise
+
+    async def achat(self, prompt, use_cache=True, timeout=AI_TIMEOUT):
+        """Async version of chat(), run on the AI thread pool."""
+        return await run_blocking(self.chat, prompt, use_cache, timeout=timeout)
+
+    def chat_stream(self, prompt, use_cache=True):
+        """
+        Same interface as the other providers' chat_stream(). The local model
+        reasons inside <think> tags before answering, so the answer is only
+        known once it is complete and comes out in one piece.
+        """
+        yield self.chat(prompt, use_cache)
+
+    def astream_chat(self, prompt, use_cache=True, timeout=AI_TIMEOUT):
+        """Async iterator over chat_stream(), run on the AI thread pool."""
+        return stream_blocking(self.chat_stream, prompt, use_cache, timeout=timeout)
 
 
 
@@ -236,3 +692,497 @@ GROQ_API = GroqAPI()
 LM_STUDIO_API = LMStudioAPI()
 GOOGLE_IMAGE_API = GoogleSearchAPI()
 Z_AI_API = Z_Ai()
+
+
+# Router: every chat/vision request goes to the fastest healthy provider that
+# can serve it, failing over to the next one.
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", 50))
+ROUTER_FAILURE_THRESHOLD = int(os.getenv("ROUTER_FAILURE_THRESHOLD", 3))
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", 30))
+ROUTER_MAX_COOLDOWN = float(os.getenv("ROUTER_MAX_COOLDOWN", 300))
+ROUTER_HEALTH_INTERVAL = float(os.getenv("ROUTER_HEALTH_INTERVAL", 30))
+# Hedging: when the first backend is slower than its p90, ask a second one too
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "0") == "1"
+ROUTER_HEDGE_BUDGET = float(os.getenv("ROUTER_HEDGE_BUDGET", AI_TIMEOUT * 2))
+# Hedged attempts run here, never on AI_EXECUTOR, whose thread is the one
+# waiting for them
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=AI_MAX_WORKERS * 2, thread_name_prefix="ai-hedge")
+
+
+class ProviderStats:
+    """Rolling window of the last calls to one backend: (seconds, succeeded)."""
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, ok: bool):
+        with self._lock:
+            self.samples.append((seconds, ok))
+
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self.samples:
+                return 0.0
+            return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+    def latency(self, quantile: float = 0.5) -> Optional[float]:
+        """Latency quantile of the successful calls in the window, None before the first one."""
+        with self._lock:
+            latencies = sorted(seconds for seconds, ok in self.samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a failing backend for a while.
+
+    After failure_threshold consecutive failures the circuit opens for
+    cooldown seconds. Then a single trial request is let through (half
+    open): success closes the circuit, failure opens it again for twice as
+    long, up to max_cooldown.
+    """
+
+    def __init__(self, failure_threshold: int = ROUTER_FAILURE_THRESHOLD, cooldown: float = ROUTER_COOLDOWN,
+                 max_cooldown: float = ROUTER_MAX_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """True if a request may go through now; claims the half-open trial."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.cooldown = self.base_cooldown
+            self.trial_running = False
+
+    def release(self):
+        """Give back a claimed trial without an outcome."""
+        with self._lock:
+            self.trial_running = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None:
+                # The half-open trial failed
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.opened_at = time.monotonic()
+            elif self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class Backend:
+    """
+    One routable provider/model.
+
+    chat(prompt, image, image_id, use_cache) returns the answer and raises on
+    failure; stream(...) is the same as a generator. image is a base64 data
+    URL or None. probe(), if given, is a cheap health check; such a backend
+    is only used once a probe has passed. quota_wait(capability), if given,
+    estimates the rate-limiter wait, so a throttled backend ranks lower.
+    """
+
+    def __init__(self, name: str, capabilities: set, chat, stream=None, probe=None, expected_latency: float = 5.0,
+                 quota_wait=None):
+        self.name = name
+        self.capabilities = capabilities
+        self.chat = chat
+        self.stream = stream
+        self.probe = probe
+        # Latency assumed until the window has real samples
+        self.expected_latency = expected_latency
+        # quota_wait(capability): seconds the rate limiter would hold a request now
+        self.quota_wait = quota_wait
+        self.healthy = probe is None
+        self.stats = ProviderStats()
+        self.breaker = CircuitBreaker()
+
+    def latency(self) -> float:
+        measured = self.stats.latency()
+        return self.expected_latency if measured is None else measured
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for this backend before hedging: its p90 latency."""
+        measured = self.stats.latency(0.9)
+        return self.expected_latency if measured is None else measured
+
+    def score(self, capability: str = "chat") -> float:
+        """
+        Expected seconds to an answer: median latency stretched by the retries
+        errors cost, plus any wait for quota.
+        """
+        wait = self.quota_wait(capability) if self.quota_wait else 0.0
+        return self.latency() / max(1.0 - self.stats.error_rate(), 0.1) + wait
+
+
+class LLMRouter:
+    """
+    Sends each request to the fastest healthy backend with the needed capability.
+
+    Backends are ranked by their median latency over the last calls, weighted
+    by their error rate, skipping those whose circuit is open; if one fails the next one is tried. Backends
+    with a probe are checked in the background every health_interval seconds,
+    so a local server that goes away is skipped before a user waits on it.
+
+    With hedge=True a request that the first backend has not answered within
+    that backend's p90 latency is also sent to the next one; the first to
+    answer wins and the other is dropped.
+    """
+
+    def __init__(self, health_interval: float = ROUTER_HEALTH_INTERVAL):
+        self.backends = []
+        self.health_interval = health_interval
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._health_thread = None
+        self._lock = threading.Lock()
+
+    def register(self, backend: Backend) -> Backend:
+        self.backends.append(backend)
+        return backend
+
+    def candidates(self, capability: str) -> list:
+        able = [backend for backend in self.backends if capability in backend.capabilities and backend.healthy]
+        return sorted(able, key=lambda backend: backend.score(capability))
+
+    def _start_health_checks(self):
+        with self._lock:
+            if self._health_thread is None and any(backend.probe for backend in self.backends):
+                self._health_thread = threading.Thread(target=self._health_loop, name="ai-health", daemon=True)
+                self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            for backend in self.backends:
+                if backend.probe is None:
+                    continue
+                healthy = backend.probe()
+                if healthy != backend.healthy:
+                    logging.info(f"{backend.name} is {'healthy' if healthy else 'down'}")
+                    if healthy:
+                        backend.breaker.success()
+                backend.healthy = healthy
+            time.sleep(self.health_interval)
+
+    def _prepare(self, image_url, image_base64, capability):
+        self._start_health_checks()
+        image = image_base64
+        if image_url and not image:
+            image = download_image_as_base64(image_url)
+        if capability is None:
+            capability = "vision" if image else "chat"
+        return image, capability
+
+    def _attempts(self, capability):
+        """Backends to try, in order, claiming a circuit slot for each."""
+        candidates = self.candidates(capability)
+        if not candidates:
+            raise ProviderUnavailable(f"No backend can serve {capability}")
+        for backend in candidates:
+            if backend.breaker.allow():
+                yield backend
+
+    def _record(self, backend: Backend, started: float, error: Exception = None):
+        if isinstance(error, (ProviderUnavailable, QuotaExceeded)):
+            # Declined, not failed: keep stats and circuit as they are
+            backend.breaker.release()
+            return
+        backend.stats.record(time.monotonic() - started, error is None)
+        if error is None:
+            backend.breaker.success()
+        else:
+            logging.error(f"{backend.name} failed: {error}")
+            backend.breaker.failure()
+
+    @staticmethod
+    def _cache_key(prompt, image_id):
+        return RESPONSE_CACHE.make_key("router", "vision", prompt, None, media_id(image_id))
+
+    def cached_chat(self, prompt, image_id):
+        """Answer already given for this prompt and Telegram image, looked up without downloading it."""
+        return RESPONSE_CACHE.get(self._cache_key(prompt, image_id))
+
+    async def acached_chat(self, prompt, image_id):
+        """Async version of cached_chat(), run on the AI thread pool."""
+        return await run_blocking(self.cached_chat, prompt, image_id)
+
+    def _run_attempt(self, backend: Backend, prompt, image, image_id, use_cache, out: queue.Queue,
+                     stop: threading.Event):
+        """One hedged attempt: feed (backend, kind, item) tuples to out until done or stopped."""
+        started = time.monotonic()
+        try:
+            if backend.stream is None:
+                source = iter([backend.chat(prompt, image, image_id, use_cache)])
+            else:
+                source = backend.stream(prompt, image, image_id, use_cache)
+            for chunk in source:
+                if stop.is_set():
+                    if hasattr(source, "close"):
+                        source.close()
+                    # Lost the race: not a failure, but how long it took
+                    # so far still belongs in the latency window
+                    backend.stats.record(time.monotonic() - started, True)
+                    backend.breaker.release()
+                    return
+                out.put((backend, "chunk", chunk))
+        except Exception as e:
+            self._record(backend, started, e)
+            out.put((backend, "error", e))
+            return
+        self._record(backend, started)
+        out.put((backend, "done", None))
+
+    def _hedged_stream(self, capability, prompt, image, image_id, use_cache, budget):
+        """
+        Yield the answer of whichever backend starts answering first.
+
+        The first candidate starts right away; if it has produced nothing
+        after its hedge_delay(), the next candidate starts too. Once one
+        of them yields a piece the other is told to stop. A backend that
+        fails before answering is replaced by the next candidate. Raises
+        TimeoutError when budget seconds pass without a complete answer.
+        """
+        deadline = time.monotonic() + budget
+        attempts = self._attempts(capability)
+        out = queue.Queue()
+        stops = {}
+        running = set()
+
+        def launch(backend):
+            stops[backend] = threading.Event()
+            running.add(backend)
+            HEDGE_EXECUTOR.submit(contextvars.copy_context().run, self._run_attempt, backend, prompt, image, image_id,
+                                  use_cache, out, stops[backend])
+            return time.monotonic() + backend.hedge_delay()
+
+        primary = next(attempts, None)
+        if primary is None:
+            raise ProviderUnavailable(f"Every {capability} backend is unavailable")
+        hedge_at = launch(primary)
+        hedged = False
+        winner = None
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise TimeoutError(f"No answer within the {budget:g}s budget")
+                wait_until = deadline if hedged or winner else min(hedge_at, deadline)
+                try:
+                    backend, kind, item = out.get(timeout=max(wait_until - now, 0))
+                except queue.Empty:
+                    if winner is None and not hedged and time.monotonic() >= hedge_at:
+                        hedged = True
+                        second = next(attempts, None)
+                        if second is not None:
+                            with self._lock:
+                                self.hedges += 1
+                            logging.info(f"{primary.name} is slow, hedging with {second.name}")
+                            launch(second)
+                    continue
+
+                if winner is not None and backend is not winner:
+                    continue  # the loser's leftovers
+                if kind == "error":
+                    running.discard(backend)
+                    if backend is winner:
+                        raise item
+                    if not running:
+                        replacement = next(attempts, None)
+                        if replacement is None:
+                            raise item
+                        primary, hedged = replacement, False
+                        hedge_at = launch(replacement)
+                    continue
+
+                if winner is None:
+                    winner = backend
+                    for other, stop in stops.items():
+                        if other is not winner:
+                            stop.set()
+                    if hedged and winner is not primary:
+                        with self._lock:
+                            self.hedge_wins += 1
+                if kind == "done":
+                    return
+                yield item
+        finally:
+            for stop in stops.values():
+                stop.set()
+
+    def chat(self, prompt, image_url=None, image_base64=None, image_id=None, use_cache=True, capability=None,
+             hedge=None, budget=ROUTER_HEDGE_BUDGET):
+        """
+        Answer prompt (and image, if any) with the best available backend.
+
+        hedge (default ROUTER_HEDGE) races a second backend against a slow
+        first one, within budget seconds. Raises the last backend error, or
+        ProviderUnavailable, if every candidate failed or was unavailable.
+        """
+        image, capability = self._prepare(image_url, image_base64, capability)
+        if ROUTER_HEDGE if hedge is None else hedge:
+            answer = "".join(self._hedged_stream(capability, prompt, image, image_id, use_cache, budget))
+            if image and image_id:
+                RESPONSE_CACHE.set(self._cache_key(prompt, image_id), answer, AI_MEDIA_CACHE_TTL)
+            return answer
+
+        last_error = ProviderUnavailable(f"Every {capability} backend is unavailable")
+        for backend in self._attempts(capability):
+            started = time.monotonic()
+            try:
+                answer = backend.chat(prompt, image, image_id, use_cache)
+            except Exception as e:
+                self._record(backend, started, e)
+                last_error = e
+                continue
+            self._record(backend, started)
+            if image and image_id:
+                RESPONSE_CACHE.set(self._cache_key(prompt, image_id), answer, AI_MEDIA_CACHE_TTL)
+            return answer
+        raise last_error
+
+    async def achat(self, prompt, image_url=None, image_base64=None, image_id=None, use_cache=True,
+                    capability=None, hedge=None, budget=ROUTER_HEDGE_BUDGET, timeout=AI_TIMEOUT * 2):
+        """Async version of chat(), run on the AI thread pool."""
+        return await run_blocking(self.chat, prompt, image_url, image_base64, image_id, use_cache, capability,
+                                  hedge, budget, timeout=timeout)
+
+    def chat_stream(self, prompt, image_url=None, image_base64=None, image_id=None, use_cache=True,
+                    capability=None, hedge=None, budget=ROUTER_HEDGE_BUDGET):
+        """
+        Like chat(), but yields the answer in pieces. A backend that fails
+        before its first piece is failed over; after that the error is raised.
+        When hedging, the race is decided by the first piece.
+        """
+        image, capability = self._prepare(image_url, image_base64, capability)
+        if ROUTER_HEDGE if hedge is None else hedge:
+            parts = []
+            for chunk in self._hedged_stream(capability, prompt, image, image_id, use_cache, budget):
+                parts.append(chunk)
+                yield chunk
+            if image and image_id:
+                RESPONSE_CACHE.set(self._cache_key(prompt, image_id), "".join(parts), AI_MEDIA_CACHE_TTL)
+            return
+
+        last_error = ProviderUnavailable(f"Every {capability} backend is unavailable")
+        for backend in self._attempts(capability):
+            started = time.monotonic()
+            parts = []
+            try:
+                if backend.stream is None:
+                    parts.append(backend.chat(prompt, image, image_id, use_cache))
+                    yield parts[0]
+                else:
+                    for chunk in backend.stream(prompt, image, image_id, use_cache):
+                        parts.append(chunk)
+                        yield chunk
+            except GeneratorExit:
+                # The caller stopped reading; no outcome to record
+                backend.breaker.release()
+                raise
+            except Exception as e:
+                self._record(backend, started, e)
+                if parts:
+                    raise
+                last_error = e
+                continue
+            self._record(backend, started)
+            if image and image_id:
+                RESPONSE_CACHE.set(self._cache_key(prompt, image_id), "".join(parts), AI_MEDIA_CACHE_TTL)
+            return
+        raise last_error
+
+    def astream_chat(self, prompt, image_url=None, image_base64=None, image_id=None, use_cache=True,
+                     capability=None, hedge=None, budget=ROUTER_HEDGE_BUDGET, timeout=AI_TIMEOUT * 2):
+        """Async iterator over chat_stream(), run on the AI thread pool."""
+        return stream_blocking(self.chat_stream, prompt, image_url, image_base64, image_id, use_cache, capability,
+                               hedge, budget, timeout=timeout)
+
+    def stats(self) -> dict:
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "backends": {
+                backend.name: {
+                    "capabilities": sorted(backend.capabilities),
+                    "healthy": backend.healthy,
+                    "circuit": backend.breaker.state,
+                    "latency_p50": backend.stats.latency(0.5),
+                    "latency_p90": backend.stats.latency(0.9),
+                    "error_rate": backend.stats.error_rate(),
+                    "calls": len(backend.stats.samples),
+                }
+                for backend in self.backends
+            },
+        }
+
+
+def _raw_base64(image: str) -> str:
+    """Strip the data URL prefix Groq's vision() adds itself."""
+    return image.split(",", 1)[1] if image.startswith("data:") else image
+
+
+def _groq_chat(prompt, image, image_id, use_cache):
+    if image:
+        return GROQ_API.vision(prompt, _raw_base64(image), use_cache)
+    return GROQ_API.chat(prompt, use_cache, raise_errors=True)
+
+
+def _groq_stream(prompt, image, image_id, use_cache):
+    if image:
+        yield GROQ_API.vision(prompt, _raw_base64(image), use_cache)
+    else:
+        yield from GROQ_API.chat_stream(prompt, use_cache, raise_errors=True)
+
+
+LLM_ROUTER = LLMRouter()
+LLM_ROUTER.register(Backend(
+    "lm_studio", {"chat"},
+    chat=lambda prompt, image, image_id, use_cache: LM_STUDIO_API.chat(prompt, use_cache),
+    stream=lambda prompt, image, image_id, use_cache: LM_STUDIO_API.chat_stream(prompt, use_cache),
+    probe=LM_STUDIO_API.is_avaiable,
+    expected_latency=3.0,
+))
+LLM_ROUTER.register(Backend(
+    "groq", {"chat", "vision"},
+    chat=_groq_chat,
+    stream=_groq_stream,
+    expected_latency=4.0,
+    quota_wait=lambda capability: RATE_LIMITS.wait_time(
+        "groq", GROQ_API.vision_model if capability == "vision" else GROQ_API.chat_model),
+))
+LLM_ROUTER.register(Backend(
+    "z_ai", {"chat", "vision"},
+    chat=lambda prompt, image, image_id, use_cache: Z_AI_API.chat(
+        prompt, image_base64=image, use_cache=use_cache, image_id=image_id, raise_errors=True),
+    stream=lambda prompt, image, image_id, use_cache: Z_AI_API.chat_stream(
+        prompt, image_base64=image, use_cache=use_cache, image_id=image_id, raise_errors=True),
+    expected_latency=6.0,
+))
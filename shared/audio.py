@@ -0,0 +1,190 @@
+"""
+ffmpeg helpers for transcription: compression, silence detection and chunking.
+
+Before upload every recording is reduced to what Whisper uses anyway:
+16 kHz mono speech, encoded as low-bitrate Opus, with the leading and
+trailing silence trimmed. That is about a tenth of a 128 kbit/s mp3 and
+far less than a video with its picture.
+
+Long recordings are cut into chunks of about CHUNK_SECONDS at the silence
+closest to each boundary, so no word is split between two chunks and the
+chunks can be transcribed in parallel.
+
+Recordings are handled in memory: ffmpeg reads them from stdin and writes
+to stdout, and one pass produces the compressed audio, its duration and its
+silences. Only containers that cannot be read from a pipe (MP4s with their
+index at the end) and files too large to keep in memory are spooled to
+SPOOL_DIR, a tmpfs when the host has one. ffmpeg must be on PATH (the bot
+images install it).
+"""
+import contextlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+from typing import Optional, Union
+
+# Target chunk length; a chunk is cut at a silence between half and all of it
+CHUNK_SECONDS = float(os.getenv("TRANSCRIBE_CHUNK_SECONDS", 300))
+# Groq rejects uploads above 25 MB on the free tier
+MAX_UPLOAD_BYTES = int(os.getenv("TRANSCRIBE_MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+SILENCE_NOISE = os.getenv("SILENCE_NOISE", "-35dB")
+SILENCE_MIN_SECONDS = float(os.getenv("SILENCE_MIN_SECONDS", 0.4))
+FFMPEG_TIMEOUT = 600
+
+# Uploads (whole files and chunks) are 16 kHz mono Opus; 24 kbit/s keeps
+# speech intelligible. TRANSCRIBE_CODEC=flac trades size for lossless audio.
+if os.getenv("TRANSCRIBE_CODEC", "opus") == "flac":
+    CHUNK_EXTENSION, CHUNK_FORMAT = "flac", "flac"
+    CHUNK_CODEC_ARGS = ["-ar", "16000", "-ac", "1", "-c:a", "flac"]
+else:
+    CHUNK_EXTENSION, CHUNK_FORMAT = "ogg", "ogg"
+    CHUNK_CODEC_ARGS = ["-ar", "16000", "-ac", "1", "-c:a", "libopus", "-b:a",
+                        os.getenv("TRANSCRIBE_BITRATE", "24k"), "-application", "voip"]
+
+TRIM_SILENCE = os.getenv("TRANSCRIBE_TRIM_SILENCE", "1") == "1"
+TRIM_START_FILTER = "silenceremove=start_periods=1:start_threshold=-50dB:start_silence=0.3"
+# Silence kept before the cut when trailing silence is trimmed
+TRIM_END_PADDING = 0.3
+
+# Where media that does not stay in memory is written; /dev/shm keeps it off the disk
+SPOOL_DIR = os.getenv("MEDIA_SPOOL_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+OUT_TIME = re.compile(r"^out_time_us=(\d+)", re.MULTILINE)
+
+
+@contextlib.contextmanager
+def spooled(data: bytes = None, suffix: str = ""):
+    """Path of a new file in SPOOL_DIR (holding data, if given), deleted when the block exits."""
+    handle, path = tempfile.mkstemp(suffix=suffix, dir=SPOOL_DIR)
+    try:
+        with os.fdopen(handle, "wb") as file:
+            if data is not None:
+                file.write(data)
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def parse_silences(log: str, total: float) -> list:
+    """(start, end) of every silence reported by ffmpeg's silencedetect, in seconds."""
+    silences = []
+    start = None
+    for line in log.splitlines():
+        match = SILENCE_START.search(line)
+        if match:
+            start = max(float(match.group(1)), 0.0)
+            continue
+        match = SILENCE_END.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    if start is not None:
+        # Older ffmpeg versions do not close a silence that lasts until the end
+        silences.append((start, total))
+    return silences
+
+
+def compress(source: Union[str, bytes], trim: bool = TRIM_SILENCE) -> Optional[tuple]:
+    """
+    (audio, duration, silences) of source, a file path or the file's bytes.
+
+    audio is the recording as 16 kHz mono CHUNK_EXTENSION, without any video
+    stream and, with trim, without its leading silence; duration and
+    silences are measured on it. Returns None if ffmpeg fails or nothing
+    but silence is left, so the caller can send the original instead.
+    """
+    filters = ["aresample=16000", "aformat=channel_layouts=mono"]
+    if trim:
+        filters.append(TRIM_START_FILTER)
+    filters.append(f"silencedetect=noise={SILENCE_NOISE}:d={SILENCE_MIN_SECONDS}")
+
+    in_memory = not isinstance(source, str)
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:2", "-i", "pipe:0" if in_memory else source,
+             "-vn", "-af", ",".join(filters), *CHUNK_CODEC_ARGS, "-f", CHUNK_FORMAT, "pipe:1"],
+            input=source if in_memory else None, capture_output=True, timeout=FFMPEG_TIMEOUT, check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        if in_memory:
+            # Containers with their index at the end cannot be read from a pipe
+            with spooled(source) as path:
+                return compress(path, trim)
+        logging.error(f"Could not compress {source}: {e.stderr.decode(errors='replace')[-500:]}")
+        return None
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.error(f"Could not compress audio: {e}")
+        return None
+
+    log = result.stderr.decode(errors="replace")
+    times = OUT_TIME.findall(log)
+    total = int(times[-1]) / 1_000_000 if times else 0.0
+    if not result.stdout or total <= 0:
+        return None
+    return result.stdout, total, parse_silences(log, total)
+
+
+def plan_chunks(total: float, silences: list, chunk_seconds: float = CHUNK_SECONDS) -> list:
+    """
+    (start, end) of each chunk, in order, covering 0..total.
+
+    Each cut goes at the middle of the latest silence between half a chunk
+    and a full chunk after the previous cut, or at exactly one chunk when
+    there is no silence in that range.
+    """
+    cuts = [(start + end) / 2 for start, end in silences]
+    chunks = []
+    position = 0.0
+    while total - position > chunk_seconds:
+        target = position + chunk_seconds
+        candidates = [cut for cut in cuts if position + chunk_seconds / 2 <= cut <= target]
+        cut = max(candidates) if candidates else target
+        chunks.append((position, cut))
+        position = cut
+    chunks.append((position, total))
+    return chunks
+
+
+def extract(audio: bytes, start: float, end: float) -> bytes:
+    """The part of audio (as returned by compress()) between start and end seconds, in the same format."""
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-ss", f"{start:.3f}", "-to", f"{end:.3f}",
+         *CHUNK_CODEC_ARGS, "-f", CHUNK_FORMAT, "pipe:1"],
+        input=audio, capture_output=True, timeout=FFMPEG_TIMEOUT, check=True,
+    )
+    return result.stdout
+
+
+def prepare(source: Union[str, bytes], trim: bool = TRIM_SILENCE,
+            chunk_seconds: float = CHUNK_SECONDS) -> Optional[tuple]:
+    """
+    (audio, chunks) ready for upload, or None when source could not be compressed.
+
+    audio is the compressed recording; chunks is None when it can be sent in
+    one piece, or the (start, end) plan to extract() when it is longer than
+    chunk_seconds or larger than MAX_UPLOAD_BYTES. With trim, trailing
+    silence is left out as well.
+    """
+    compressed = compress(source, trim)
+    if compressed is None:
+        return None
+    audio, total, silences = compressed
+
+    end = total
+    if trim and silences and silences[-1][1] >= total - 0.05:
+        end = min(silences[-1][0] + TRIM_END_PADDING, total)
+
+    if end <= chunk_seconds and len(audio) <= MAX_UPLOAD_BYTES:
+        if total - end > 1:
+            try:
+                audio = extract(audio, 0, end)
+            except (OSError, subprocess.SubprocessError) as e:
+                logging.error(f"Could not trim trailing silence: {e}")
+        return audio, None
+    # A 16 kHz mono chunk of CHUNK_SECONDS stays well under the upload limit
+    return audio, plan_chunks(end, silences, chunk_seconds)
@@ -0,0 +1,113 @@
+"""
+Benchmark for the History queries before and after the index migration.
+
+Builds a throwaway database with the pre-index schema, fills it with fake
+messages, times the History query shapes, applies the remaining migrations
+and times them again.
+
+Usage (from the repository root):
+    python -m shared.bench_database --rows 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from shared.database import SCHEMA_VERSION, get_connection, migrate
+
+START_MS = int(datetime(2020, 1, 1).timestamp() * 1000)
+DAY_MS = 86_400_000
+SPAN_MS = DAY_MS * 365 * 5
+
+USERS = [f"user{i}" for i in range(50)]
+KINDS = ["text"] * 8 + ["photo", "video", "voice", "sticker", "discord_event", "steam_event"]
+
+# Same query shapes History runs
+QUERIES = {
+    "get_all_messages(100)": ("SELECT * FROM messages ORDER BY created DESC LIMIT ?", lambda rows: (100,)),
+    "get_messages_by_user(100)": (
+        "SELECT * FROM messages WHERE user = ? ORDER BY created DESC LIMIT ?",
+        lambda rows: (random.choice(USERS), 100),
+    ),
+    "get_message(message_id)": (
+        "SELECT * FROM messages WHERE message_id = ?",
+        lambda rows: (str(random.randrange(rows)),),
+    ),
+    "get_messages_between(1 day)": (
+        "SELECT * FROM messages WHERE created >= ? AND created < ? ORDER BY created DESC LIMIT ?",
+        lambda rows: (START_MS + DAY_MS * 100, START_MS + DAY_MS * 101, 1000),
+    ),
+    "kind range (100)": (
+        "SELECT * FROM messages WHERE kind = ? ORDER BY created DESC LIMIT ?",
+        lambda rows: ("voice", 100),
+    ),
+}
+
+
+def fill(conn: sqlite3.Connection, rows: int, batch: int = 50_000):
+    for offset in range(0, rows, batch):
+        chunk = [
+            (
+                random.choice(USERS),
+                str(i),
+                f"mensagem de teste numero {i}",
+                None,
+                0,
+                random.choice(KINDS),
+                START_MS + random.randrange(SPAN_MS),
+            )
+            for i in range(offset, min(offset + batch, rows))
+        ]
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (user, message_id, text, replied_to, from_bot, kind, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                chunk,
+            )
+
+
+def time_queries(conn: sqlite3.Connection, rows: int, repeat: int) -> dict:
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        conn.execute(sql, params(rows)).fetchall()  # warm the page cache
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params(rows)).fetchall()
+        results[name] = (time.perf_counter() - started) / repeat * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        conn = get_connection(db_path).conn
+        migrate(conn, target=1)
+
+        started = time.perf_counter()
+        fill(conn, args.rows)
+        print(f"Inserted {args.rows} rows in {time.perf_counter() - started:.1f}s")
+
+        before = time_queries(conn, args.rows, args.repeat)
+
+        started = time.perf_counter()
+        migrate(conn)
+        print(f"Migrated to version {SCHEMA_VERSION} in {time.perf_counter() - started:.1f}s")
+
+        after = time_queries(conn, args.rows, args.repeat)
+
+        print(f"\n{'query':<32}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+        for name in QUERIES:
+            speedup = before[name] / after[name] if after[name] else float("inf")
+            print(f"{name:<32}{before[name]:>14.2f}{after[name]:>14.3f}{speedup:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Two-tier cache shared by the services: an in-process LRU in front of SQLite.
+
+RESPONSE_CACHE holds model answers and transcriptions (shared/ai_tools.py);
+other callers make their own ResponseCache for their kind of value. Every
+instance uses the same table in shared/cache.db under its own namespace,
+with its own TTLs, size cap and memory tier; expiry and eviction only ever
+touch the instance's own namespace.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+from shared.database import connect, now_ms
+
+# Response cache: identical prompts are answered from here instead of the
+# provider. AI_CACHE=0 turns it off; every chat method also takes use_cache.
+AI_CACHE_ENABLED = os.getenv("AI_CACHE", "1") != "0"
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", 24 * 3600))
+AI_CACHE_MAX_BYTES = int(os.getenv("AI_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+AI_CACHE_MEMORY_ENTRIES = int(os.getenv("AI_CACHE_MEMORY_ENTRIES", 512))
+# Transcriptions and image answers only depend on the media, so they live longer
+AI_MEDIA_CACHE_TTL = float(os.getenv("AI_MEDIA_CACHE_TTL", 30 * 24 * 3600))
+
+# Seconds between sweeps of expired entries (expired entries are never served)
+CACHE_PURGE_INTERVAL = 300
+# Last-used times of hits are written in batches: after this many hits or seconds
+CACHE_TOUCH_BATCH = 64
+CACHE_TOUCH_INTERVAL = 30.0
+
+
+class ResponseCache:
+    """
+    Two-tier cache of model answers: an in-process LRU in front of an SQLite table.
+
+    The SQLite tier (shared/cache.db) is shared by every service. Entries
+    expire after their TTL, and once the namespace holds more than max_bytes
+    of values the least recently used entries are evicted. The size is kept
+    as a running total and only recounted when it crosses max_bytes; hits
+    record their last-used time in batches, so a read does not take the
+    database's write lock. Only successful answers should be stored; error
+    strings must never be cached.
+    """
+
+    def __init__(self, db_path: str = None, ttl: float = AI_CACHE_TTL, max_bytes: int = AI_CACHE_MAX_BYTES,
+                 memory_entries: int = AI_CACHE_MEMORY_ENTRIES, enabled: bool = AI_CACHE_ENABLED,
+                 namespace: str = "ai"):
+        if db_path is None:
+            db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db")
+        self.db_path = db_path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.enabled = enabled
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        # Bytes stored under the namespace, as far as this process knows
+        self._bytes = 0
+        self._purged = 0.0
+        # key -> last hit, not yet written
+        self._touched = {}
+        self._touch_flushed = time.monotonic()
+
+    @property
+    def conn(self):
+        """Opened on first use, so importing the module never touches the disk."""
+        if self._conn is None:
+            conn = connect(self.db_path)
+            with conn:
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+                if columns and "namespace" not in columns:
+                    # Table from before namespaces; a cache can simply start over
+                    conn.execute("DROP TABLE cache")
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS cache (
+                        key TEXT PRIMARY KEY,
+                        namespace TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        expires INTEGER NOT NULL,
+                        used INTEGER NOT NULL
+                    ) WITHOUT ROWID
+                ''')
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_namespace_used ON cache (namespace, used)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_namespace_expires ON cache (namespace, expires)")
+            self._conn = conn
+            self._bytes = self._count()
+        return self._conn
+
+    def _count(self) -> int:
+        return self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages, temperature=None, image: Union[str, bytes] = None) -> str:
+        """
+        Hash of everything that decides the answer.
+
+        Images (or audio, for transcriptions) are reduced to a digest first,
+        so a large payload is hashed once and not kept around as part of the
+        key. Pass media_id(file_unique_id) instead of the content to look a
+        file up before downloading it.
+        """
+        if isinstance(image, str):
+            image = image.encode()
+        image_digest = hashlib.sha256(image).hexdigest() if image else None
+        payload = json.dumps([provider, model, messages, temperature, image_digest],
+                             ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = now_ms()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                self._touch(key, now)
+                return entry[0]
+
+            try:
+                row = self.conn.execute(
+                    "SELECT value, expires FROM cache WHERE key = ? AND expires > ?", (key, now)
+                ).fetchone()
+                if row is not None:
+                    self._touch(key, now)
+            except Exception as e:
+                logging.error(f"Error reading the response cache: {e}")
+                row = None
+
+            if row is None:
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str, ttl: float = None):
+        if not self.enabled or not value:
+            return
+        now = now_ms()
+        expires = now + int((self.ttl if ttl is None else ttl) * 1000)
+        with self._lock:
+            self._remember(key, value, expires)
+            self._touched.pop(key, None)
+            size = len(value.encode())
+            try:
+                with self.conn:
+                    old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+                    self.conn.execute('''
+                        INSERT INTO cache (key, namespace, value, size, expires, used) VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (key) DO UPDATE SET
+                            namespace = excluded.namespace, value = excluded.value, size = excluded.size,
+                            expires = excluded.expires, used = excluded.used
+                    ''', (key, self.namespace, value, size, expires, now))
+                    self._bytes += size - (old[0] if old else 0)
+                    self._flush_touched()
+                    self._evict(now)
+            except Exception as e:
+                logging.error(f"Error writing the response cache: {e}")
+
+    def delete(self, key: str):
+        """Forget key, e.g. when the cached value turned out to be stale."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._memory.pop(key, None)
+            self._touched.pop(key, None)
+            try:
+                with self.conn:
+                    old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+                    self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._bytes -= old[0] if old else 0
+            except Exception as e:
+                logging.error(f"Error deleting from the response cache: {e}")
+
+    def get_any(self, keys: list, ttl: float = None) -> Optional[str]:
+        """First cached value among keys; it is also stored under the other keys."""
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                self.set_all([other for other in keys if other != key], value, ttl)
+                return value
+        return None
+
+    def set_all(self, keys: list, value: str, ttl: float = None):
+        for key in keys:
+            self.set(key, value, ttl)
+
+    def _remember(self, key: str, value: str, expires: int):
+        self._memory[key] = (value, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key: str, now: int):
+        """Note a hit; last-used times are written with the next set() or once enough have piled up."""
+        self._touched[key] = now
+        if (len(self._touched) >= CACHE_TOUCH_BATCH
+                or time.monotonic() - self._touch_flushed >= CACHE_TOUCH_INTERVAL):
+            try:
+                with self.conn:
+                    self._flush_touched()
+            except Exception as e:
+                logging.error(f"Error updating the response cache: {e}")
+
+    def _flush_touched(self):
+        """Write the pending last-used times; call inside a transaction."""
+        self._touch_flushed = time.monotonic()
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        self.conn.executemany("UPDATE cache SET used = ? WHERE key = ?",
+                              [(used, key) for key, used in touched.items()])
+
+    def _evict(self, now: int):
+        """
+        Drop the namespace's expired entries every CACHE_PURGE_INTERVAL, and
+        its least recently used ones once it holds more than max_bytes.
+        """
+        over = self._bytes > self.max_bytes
+        if over or time.monotonic() - self._purged >= CACHE_PURGE_INTERVAL:
+            self._purged = time.monotonic()
+            self.conn.execute("DELETE FROM cache WHERE namespace = ? AND expires <= ?", (self.namespace, now))
+        if not over:
+            return
+        # Other processes write to the namespace too: recount before evicting
+        self._bytes = self._count()
+        excess = self._bytes - self.max_bytes
+        if excess <= 0:
+            return
+        rows = self.conn.execute(
+            "SELECT key, size FROM cache WHERE namespace = ? ORDER BY used", (self.namespace,)
+        )
+        evicted = []
+        for key, size in rows:
+            evicted.append((key,))
+            self._memory.pop(key, None)
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+        self._bytes = self._count()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            with self.conn:
+                self.conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            size, entries = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "entries": entries,
+                "bytes": size,
+                "memory_entries": len(self._memory),
+            }
+
+
+RESPONSE_CACHE = ResponseCache()
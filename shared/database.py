@@ -1,7 +1,458 @@
+import asyncio
+import atexit
+import base64
+import functools
+import json
+import logging
+import queue
+import re
 import sqlite3
 import os
-from datetime import datetime
-from typing import Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, Union
+from urllib.request import pathname2url
+
+# Pragmas applied once to every connection. WAL lets the four containers read
+# while one of them writes, and busy_timeout makes writers wait for the lock
+# instead of failing straight away with "database is locked".
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA cache_size=-16000",    # ~16 MiB page cache
+)
+
+# Number of compiled statements kept by sqlite3 per connection
+STATEMENT_CACHE_SIZE = 128
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Open a new connection with the standard pragmas applied."""
+    conn = sqlite3.connect(
+        db_path,
+        timeout=5,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class _SharedConnection:
+    """A long-lived connection to one database file, shared inside the process."""
+
+    def __init__(self, db_path: str):
+        self.conn = connect(db_path)
+        self.lock = threading.RLock()
+        self.initialized = False
+        self.writer = None
+        self.state_cache = {}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(db_path: str) -> _SharedConnection:
+    """Return the process-wide connection for db_path, opening it on first use."""
+    db_path = os.path.abspath(db_path)
+    with _connections_lock:
+        shared = _connections.get(db_path)
+        if shared is None:
+            shared = _SharedConnection(db_path)
+            _connections[db_path] = shared
+        return shared
+
+
+class WriteBehindQueue:
+    """
+    Buffers message inserts and writes them from a background thread.
+
+    Rows are flushed with a single executemany transaction once batch_size
+    rows are waiting or flush_interval seconds after the first one arrived,
+    so a burst of messages costs one commit instead of one per message.
+    The queue is bounded and put() never waits: when max_pending rows are
+    waiting the new row is dropped and counted in `dropped`. A batch that
+    fails is retried row by row, so one bad row does not take the others
+    with it; rows that still fail are counted in `failed`.
+    """
+
+    def __init__(self, history: "History", batch_size: int = 200, flush_interval: float = 0.5,
+                 max_pending: int = 10_000):
+        self.history = history
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, row: tuple) -> bool:
+        """Queue row without waiting; returns False if it was dropped because the queue is full."""
+        if self._closed:
+            raise RuntimeError("WriteBehindQueue is closed")
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            # One line per 100 drops is enough to notice a stuck writer
+            if self.dropped % 100 == 1:
+                logging.error(f"Write-behind queue full, {self.dropped} messages dropped so far")
+            return False
+        return True
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {"pending": self.pending(), "written": self.written, "dropped": self.dropped, "failed": self.failed}
+
+    def flush(self):
+        """Block until every row queued so far has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Write everything still queued and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            row = self._queue.get()
+            if row is None:
+                self._queue.task_done()
+                break
+
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    self._queue.task_done()
+                    break
+                batch.append(row)
+
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: list):
+        try:
+            self.history.save_messages(batch)
+            self.written += len(batch)
+            return
+        except Exception as e:
+            logging.error(f"Error writing {len(batch)} queued messages, retrying one by one: {e}")
+        for row in batch:
+            try:
+                self.history.save_messages([row])
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Dropping queued message {row[1]} from {row[0]}: {e}")
+
+
+@atexit.register
+def close_connections():
+    """Close every shared connection so the WAL is checkpointed on exit."""
+    with _connections_lock:
+        for shared in _connections.values():
+            shared.close()
+        _connections.clear()
+
+
+# Ordered schema migrations. Each entry is a tuple of statements that runs in
+# a single transaction; PRAGMA user_version stores how many have been applied.
+# Only ever append to this list, never edit an entry that has shipped.
+MIGRATIONS = [
+    # 1: messages table (pre-migration databases already have it)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            replied_to TEXT,
+            from_bot BOOLEAN NOT NULL DEFAULT 0,
+            kind TEXT,
+            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 2: indexes for the history lookups
+    (
+        "CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages (user, created)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_kind_created ON messages (kind, created)",
+    ),
+    # 3: full-text index over messages.text, kept in sync by triggers
+    (
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        ''',
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ),
+    # 4: created becomes integer epoch milliseconds (UTC). Older rows hold the
+    # naive local time written by datetime.now() through the sqlite3 adapter;
+    # the 'utc' modifier converts it with the host's zone, as to_epoch_ms does.
+    (
+        '''
+        UPDATE messages
+        SET created = CAST(ROUND((julianday(created, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+        WHERE typeof(created) = 'text' AND julianday(created) IS NOT NULL
+        ''',
+    ),
+    # 5: per-user daily activity rollups, maintained by an insert trigger.
+    # Days are UTC dates; kind is '' for messages without a kind. Bot
+    # messages are not counted.
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS activity_daily (
+            day TEXT NOT NULL,
+            user TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            characters INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user, kind)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS activity_daily_insert AFTER INSERT ON messages
+        WHEN typeof(new.created) = 'integer' AND NOT new.from_bot
+        BEGIN
+            INSERT INTO activity_daily (day, user, kind, messages, characters)
+            VALUES (date(new.created / 1000, 'unixepoch'), new.user, COALESCE(new.kind, ''), 1, length(new.text))
+            ON CONFLICT (day, user, kind) DO UPDATE SET
+                messages = messages + 1,
+                characters = characters + excluded.characters;
+        END
+        ''',
+        '''
+        INSERT INTO activity_daily (day, user, kind, messages, characters)
+        SELECT date(created / 1000, 'unixepoch'), user, COALESCE(kind, ''), COUNT(*), SUM(length(text))
+        FROM messages
+        WHERE typeof(created) = 'integer' AND NOT from_bot
+        GROUP BY 1, 2, 3
+        ''',
+    ),
+    # 6: key-value store for bot bookkeeping (values are JSON)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+    ),
+    # 7: per-chat partitioning. Existing rows keep a NULL chat_id and their
+    # rollups move to chat_id ''. Rollups gain a from_bot column, so the
+    # webhook's bot rows (voice and Steam events) are kept apart from people.
+    (
+        "ALTER TABLE messages ADD COLUMN chat_id TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_user_created ON messages (chat_id, user, created)",
+        "DROP TRIGGER IF EXISTS activity_daily_insert",
+        "ALTER TABLE activity_daily RENAME TO activity_daily_old",
+        '''
+        CREATE TABLE activity_daily (
+            chat_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            user TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            from_bot INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0,
+            characters INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, day, user, kind, from_bot)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT INTO activity_daily (chat_id, day, user, kind, from_bot, messages, characters)
+        SELECT '', day, user, kind, 0, messages, characters FROM activity_daily_old
+        ''',
+        "DROP TABLE activity_daily_old",
+        '''
+        CREATE TRIGGER activity_daily_insert AFTER INSERT ON messages
+        WHEN typeof(new.created) = 'integer'
+        BEGIN
+            INSERT INTO activity_daily (chat_id, day, user, kind, from_bot, messages, characters)
+            VALUES (COALESCE(new.chat_id, ''), date(new.created / 1000, 'unixepoch'), new.user,
+                    COALESCE(new.kind, ''), CASE WHEN new.from_bot THEN 1 ELSE 0 END, 1, length(new.text))
+            ON CONFLICT (chat_id, day, user, kind, from_bot) DO UPDATE SET
+                messages = messages + 1,
+                characters = characters + excluded.characters;
+        END
+        ''',
+    ),
+    # 8: Telegram file_id of every video the bot has sent for a link, keyed
+    # by normalized URL, so a repost is sent again without downloading it
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS media_files (
+            url TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            kind TEXT NOT NULL,
+            title TEXT,
+            created INTEGER NOT NULL,
+            used INTEGER NOT NULL,
+            sends INTEGER NOT NULL DEFAULT 1
+        ) WITHOUT ROWID
+        ''',
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, target: Optional[int] = None) -> int:
+    """
+    Apply pending migrations up to target (default: latest) and return the new version.
+
+    Every migration runs in its own BEGIN IMMEDIATE transaction and the version
+    is re-read after taking the write lock, so several services starting at
+    the same time apply each migration exactly once.
+    """
+    target = SCHEMA_VERSION if target is None else target
+    version = get_schema_version(conn)
+    while version < target:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = get_schema_version(conn)
+            if version >= target:
+                conn.rollback()
+                break
+            for statement in MIGRATIONS[version]:
+                conn.execute(statement)
+            version += 1
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return version
+
+
+Timestamp = Union[datetime, int, float]
+
+
+def now_ms() -> int:
+    """Current time as epoch milliseconds, the format of messages.created."""
+    return time.time_ns() // 1_000_000
+
+
+def to_epoch_ms(value: Timestamp) -> int:
+    """Convert a datetime (naive means local time) or epoch milliseconds to epoch milliseconds."""
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    return int(value)
+
+
+def from_epoch_ms(value: int) -> datetime:
+    """Convert a messages.created value to a local naive datetime."""
+    return datetime.fromtimestamp(value / 1000)
+
+
+def to_day(value: Timestamp) -> str:
+    """UTC date ('YYYY-MM-DD') of a datetime or epoch milliseconds, as used by the rollups."""
+    return time.strftime("%Y-%m-%d", time.gmtime(to_epoch_ms(value) / 1000))
+
+
+# Column order of the messages table, as returned by SELECT *
+COLUMNS = ("id", "user", "message_id", "text", "replied_to", "from_bot", "kind", "created", "chat_id")
+
+
+def row_to_dict(row: tuple) -> dict:
+    return dict(zip(COLUMNS, row))
+
+
+def encode_cursor(row: tuple) -> str:
+    """Opaque pagination cursor pointing just past row, keyed on (created, id)."""
+    position = [row[COLUMNS.index("created")], row[0]]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return created, row_id
+
+
+def fts_query(text: str) -> str:
+    """
+    Turn free text typed by a user into an FTS5 query.
+
+    Every word is quoted so characters like '-', ':' or '*' are matched
+    literally instead of being parsed as FTS5 syntax; the words are ANDed.
+    """
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"' for term in terms if term)
+
+
+# Archived months live next to the hot database as archive/messages-YYYY-MM.db
+ARCHIVE_DIRNAME = "archive"
+ARCHIVE_NAME = re.compile(r"messages-(\d{4})-(\d{2})\.db")
+
+
+def archive_name(year: int, month: int) -> str:
+    return f"messages-{year:04d}-{month:02d}.db"
+
 
 class History:
     def __init__(self, db_path: str = None):
@@ -10,66 +461,366 @@ class History:
             # Get the shared directory
             shared_dir = os.path.dirname(os.path.abspath(__file__))
             db_path = os.path.join(shared_dir, "..", "shared/messages.db")
-        
+
         self.db_path = db_path
+        self.archive_dir = os.path.join(os.path.dirname(os.path.abspath(db_path)), ARCHIVE_DIRNAME)
+        self._shared = get_connection(db_path)
+        self.conn = self._shared.conn
+        self._lock = self._shared.lock
         self.init_db()
-    
+
     def init_db(self):
-        """Initialize the database and create the messages table if it doesn't exist."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            # Create the messages table with the new 'kind' field
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user TEXT NOT NULL,
-                    message_id TEXT NOT NULL,
-                    text TEXT NOT NULL,
-                    replied_to TEXT,
-                    from_bot BOOLEAN NOT NULL DEFAULT 0,
-                    kind TEXT,
-                    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            conn.commit()
-    
-    def save_message(self, user: str, message_id: str, text: str, replied_to: Optional[str] = None, from_bot: bool = False, kind: Optional[str] = None):
+        """Bring the database schema up to date, once per process."""
+        with self._lock:
+            if self._shared.initialized:
+                return
+            migrate(self.conn)
+            self._shared.initialized = True
+
+    def save_message(self, user: str, message_id: str, text: str, replied_to: Optional[str] = None, from_bot: bool = False, kind: Optional[str] = None, chat_id: Optional[str] = None):
         """Save a message to the database."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO messages (user, message_id, text, replied_to, from_bot, kind, created)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user, message_id, text, replied_to, from_bot, kind, datetime.now()))
-            conn.commit()
+        with self._lock, self.conn:
+            cursor = self.conn.execute('''
+                INSERT INTO messages (user, message_id, text, replied_to, from_bot, kind, created, chat_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user, message_id, text, replied_to, from_bot, kind, now_ms(), chat_id))
             return cursor.lastrowid
-    
-    def get_message(self, message_id: str):
+
+    def save_messages(self, rows: list):
+        """
+        Insert many messages in one transaction.
+
+        Each row is (user, message_id, text, replied_to, from_bot, kind, created, chat_id),
+        with created in epoch milliseconds.
+        """
+        with self._lock, self.conn:
+            self.conn.executemany('''
+                INSERT INTO messages (user, message_id, text, replied_to, from_bot, kind, created, chat_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    def enqueue_message(self, user: str, message_id: str, text: str, replied_to: Optional[str] = None, from_bot: bool = False, kind: Optional[str] = None, chat_id: Optional[str] = None):
+        """
+        Queue a message for the background writer instead of inserting it now.
+
+        The creation time is taken here, not when the batch is flushed.
+        Returns False if the queue was full and the message was dropped.
+        """
+        return self.writer.put((user, message_id, text, replied_to, from_bot, kind, now_ms(), chat_id))
+
+    @property
+    def writer(self) -> WriteBehindQueue:
+        """The write-behind queue for this database, started on first use."""
+        with self._lock:
+            if self._shared.writer is None:
+                self._shared.writer = WriteBehindQueue(self)
+            return self._shared.writer
+
+    def flush(self):
+        """Wait for queued messages to be written, if a writer was started."""
+        if self._shared.writer is not None:
+            self._shared.writer.flush()
+
+    def close_writer(self):
+        """Flush queued messages and stop the background writer."""
+        with self._lock:
+            writer, self._shared.writer = self._shared.writer, None
+        if writer is not None:
+            writer.close()
+
+    def get_state(self, key: str, default=None):
+        """
+        Read a bookkeeping value, served from the in-process cache after the first read.
+
+        The cache is per process and only updated by this process's
+        set_state/delete_state calls, so a key should be owned by one service.
+        """
+        with self._lock:
+            cache = self._shared.state_cache
+            if key not in cache:
+                row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+                cache[key] = json.loads(row[0]) if row else None
+            value = cache[key]
+        return default if value is None else value
+
+    def set_state(self, key: str, value):
+        """Store a JSON-serialisable bookkeeping value."""
+        with self._lock:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT INTO state (key, value, updated) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated = excluded.updated
+                ''', (key, json.dumps(value), now_ms()))
+            self._shared.state_cache[key] = value
+
+    def delete_state(self, key: str):
+        with self._lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            self._shared.state_cache[key] = None
+
+    def get_media_file(self, url: str) -> Optional[dict]:
+        """The Telegram file sent for a normalized link before, as a dict with file_id, kind and title."""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT file_id, kind, title FROM media_files WHERE url = ?', (url,)
+            ).fetchone()
+        return {"file_id": row[0], "kind": row[1], "title": row[2]} if row else None
+
+    def save_media_file(self, url: str, file_id: str, kind: str, title: Optional[str] = None,
+                        file_unique_id: Optional[str] = None):
+        """Remember the Telegram file sent for a normalized link; kind is "video" or "animation"."""
+        now = now_ms()
+        with self._lock, self.conn:
+            self.conn.execute('''
+                INSERT INTO media_files (url, file_id, file_unique_id, kind, title, created, used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    file_id = excluded.file_id, file_unique_id = excluded.file_unique_id,
+                    kind = excluded.kind, title = excluded.title, used = excluded.used
+            ''', (url, file_id, file_unique_id, kind, title, now, now))
+
+    def media_file_sent(self, url: str):
+        """Count another send of a remembered file."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE media_files SET used = ?, sends = sends + 1 WHERE url = ?', (now_ms(), url)
+            )
+
+    def delete_media_file(self, url: str):
+        """Forget a remembered file, e.g. after Telegram refused its file_id."""
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM media_files WHERE url = ?', (url,))
+
+    def _select(self, conditions: list, params: list, order: str = "created DESC", limit: Optional[int] = None):
+        """Run SELECT * FROM messages with ANDed conditions and return all rows."""
+        sql = "SELECT * FROM messages"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = params + [limit]
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _chat_filter(chat_id: Optional[str], conditions: list, params: list):
+        # chat_id=None means every chat
+        if chat_id is not None:
+            conditions.append("chat_id = ?")
+            params.append(chat_id)
+
+    def get_message(self, message_id: str, chat_id: Optional[str] = None):
         """Retrieve a message by its ID."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM messages WHERE message_id = ?', (message_id,))
-            return cursor.fetchone()
-    
-    def get_messages_by_user(self, user: str, limit: int = 100):
+        conditions, params = ["message_id = ?"], [message_id]
+        self._chat_filter(chat_id, conditions, params)
+        rows = self._select(conditions, params, order="id", limit=1)
+        return rows[0] if rows else None
+
+    def get_messages_by_user(self, user: str, limit: int = 100, chat_id: Optional[str] = None):
         """Retrieve messages sent by a specific user."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM messages 
-                WHERE user = ? 
-                ORDER BY created DESC 
-                LIMIT ?
-            ''', (user, limit))
-            return cursor.fetchall()
-    
-    def get_all_messages(self, limit: int = 100):
+        conditions, params = [], []
+        self._chat_filter(chat_id, conditions, params)
+        conditions.append("user = ?")
+        params.append(user)
+        return self._select(conditions, params, limit=limit)
+
+    def get_all_messages(self, limit: int = 100, chat_id: Optional[str] = None):
         """Retrieve all messages, ordered by creation time."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM messages 
-                ORDER BY created DESC 
-                LIMIT ?
-            ''', (limit,))
-            return cursor.fetchall()
\ No newline at end of file
+        conditions, params = [], []
+        self._chat_filter(chat_id, conditions, params)
+        return self._select(conditions, params, limit=limit)
+
+    def get_messages_between(self, start: Timestamp, end: Optional[Timestamp] = None, limit: int = 1000, chat_id: Optional[str] = None):
+        """
+        Retrieve messages created in [start, end), newest first.
+
+        start and end are datetimes or epoch milliseconds; end defaults to now.
+        """
+        end = now_ms() + 1 if end is None else to_epoch_ms(end)
+        conditions, params = [], []
+        self._chat_filter(chat_id, conditions, params)
+        conditions += ["created >= ?", "created < ?"]
+        params += [to_epoch_ms(start), end]
+        return self._select(conditions, params, limit=limit)
+
+    def get_activity(self, start: Timestamp, end: Optional[Timestamp] = None, kind: Optional[str] = None, limit: int = 10,
+                     chat_id: Optional[str] = None, include_bots: bool = False):
+        """
+        Per-user activity between the days of start and end (exclusive), most messages first.
+
+        Read from the daily rollups, so the cost grows with the number of
+        days and users in the range, not with the number of messages.
+        Bot messages are left out unless include_bots is set.
+        Returns (user, messages, characters) rows.
+        """
+        sql = "SELECT user, SUM(messages), SUM(characters) FROM activity_daily WHERE day >= ?"
+        params = [to_day(start)]
+        if not include_bots:
+            sql += " AND from_bot = 0"
+        if chat_id is not None:
+            sql += " AND chat_id = ?"
+            params.append(chat_id)
+        if end is not None:
+            sql += " AND day < ?"
+            params.append(to_day(end))
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " GROUP BY user ORDER BY SUM(messages) DESC, SUM(characters) DESC LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get_messages_page(self, user: Optional[str] = None, cursor: Optional[str] = None, limit: int = 100, chat_id: Optional[str] = None):
+        """
+        Retrieve one page of messages, newest first, using keyset pagination.
+
+        Returns (rows, next_cursor); next_cursor is None on the last page.
+        Each page is an index range scan on (created, id), so fetching page
+        N costs the same as fetching the first one.
+        """
+        conditions, params = [], []
+        self._chat_filter(chat_id, conditions, params)
+        if user is not None:
+            conditions.append("user = ?")
+            params.append(user)
+        if cursor is not None:
+            conditions.append("(created, id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        rows = self._select(conditions, params, order="created DESC, id DESC", limit=limit)
+        next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    def iter_messages(self, user: Optional[str] = None, cursor: Optional[str] = None, batch_size: int = 500, chat_id: Optional[str] = None):
+        """
+        Yield every message, newest first, in constant memory.
+
+        Rows are read in keyset-paginated batches, so the connection lock is
+        only held while a batch is fetched and writers are never blocked for
+        the length of an export.
+        """
+        while True:
+            rows, cursor = self.get_messages_page(user, cursor, batch_size, chat_id)
+            yield from rows
+            if cursor is None:
+                return
+
+    def archive_paths(self) -> list:
+        """
+        Archived months as (month_start, month_end, path), newest first.
+
+        month_start and month_end are epoch milliseconds (UTC).
+        """
+        if not os.path.isdir(self.archive_dir):
+            return []
+        archives = []
+        for name in os.listdir(self.archive_dir):
+            match = ARCHIVE_NAME.fullmatch(name)
+            if not match:
+                continue
+            year, month = int(match.group(1)), int(match.group(2))
+            next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+            start = to_epoch_ms(datetime(year, month, 1, tzinfo=timezone.utc))
+            end = to_epoch_ms(datetime(next_year, next_month, 1, tzinfo=timezone.utc))
+            archives.append((start, end, os.path.join(self.archive_dir, name)))
+        return sorted(archives, reverse=True)
+
+    def search(self, query: str, user: Optional[str] = None, since: Optional[Timestamp] = None,
+               limit: int = 20, highlight: tuple = ("**", "**"), include_archives: bool = True,
+               chat_id: Optional[str] = None):
+        """
+        Full-text search over message texts, best matches first.
+
+        Returns the message rows with a highlighted snippet appended as the
+        last column. Optionally restricted to one chat, one user and to
+        messages created at or after since. When the hot database has fewer than
+        limit matches, the monthly archives are searched newest first;
+        archives that end before since are skipped. Archives are opened
+        read-only for the query and closed after it.
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+        since = None if since is None else to_epoch_ms(since)
+
+        with self._lock:
+            results = self._search(self.conn, match, user, since, limit, highlight, chat_id)
+        if include_archives:
+            for _, month_end, path in self.archive_paths():
+                if len(results) >= limit:
+                    break
+                if since is not None and month_end <= since:
+                    break
+                conn = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True)
+                try:
+                    results += self._search(conn, match, user, since, limit - len(results), highlight, chat_id)
+                except sqlite3.Error as e:
+                    logging.error(f"Error searching archive {path}: {e}")
+                finally:
+                    conn.close()
+        return results
+
+    @staticmethod
+    def _search(conn: sqlite3.Connection, match: str, user: Optional[str], since: Optional[int], limit: int,
+                highlight: tuple, chat_id: Optional[str]):
+        sql = '''
+            SELECT m.*, snippet(messages_fts, 0, ?, ?, '…', 12)
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        '''
+        params = [highlight[0], highlight[1], match]
+        if chat_id is not None:
+            sql += " AND m.chat_id = ?"
+            params.append(chat_id)
+        if user is not None:
+            sql += " AND m.user = ?"
+            params.append(user)
+        if since is not None:
+            sql += " AND m.created >= ?"
+            params.append(since)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        return conn.execute(sql, params).fetchall()
+
+
+class AsyncHistory:
+    """
+    Awaitable facade over History for asyncio code.
+
+    Every History method is available as a coroutine that runs on a single
+    dedicated database thread, so a slow write or a lock wait suspends only
+    the awaiting handler instead of the whole event loop.
+    """
+
+    def __init__(self, history: Optional[History] = None, db_path: str = None):
+        self.history = history or History(db_path)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-db")
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the database thread and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.history, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return call
+
+    async def iter_messages(self, user: Optional[str] = None, cursor: Optional[str] = None, batch_size: int = 500, chat_id: Optional[str] = None):
+        """Async version of History.iter_messages, fetching each batch on the database thread."""
+        while True:
+            rows, cursor = await self.run(self.history.get_messages_page, user, cursor, batch_size, chat_id)
+            for row in rows:
+                yield row
+            if cursor is None:
+                return
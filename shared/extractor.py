@@ -0,0 +1,473 @@
+"""
+yt-dlp in a pool of worker processes, off the bots' event loops.
+
+extract_info() is CPU-heavy and sometimes hangs for minutes on a bad link;
+run inline it stalls the Discord gateway or Telegram polling for everyone.
+EXTRACTOR keeps a few warm worker processes (yt-dlp already imported) and
+runs each call in one of them:
+
+- every call has a deadline; a worker that misses it, or whose caller is
+  cancelled, is killed and replaced, without touching the other calls
+- a worker is replaced after EXTRACT_TASKS_PER_CHILD calls, which caps the
+  memory yt-dlp accumulates in a long-lived process
+- yt-dlp errors are raised again in the caller as the same classes
+  (DownloadError, ExtractorError, ...), so existing handlers keep working
+
+Workers are forked, so they start fast and do not import the bot's main
+module again; they only ever run yt-dlp. Forking a process that runs
+threads can leave the child stuck on a lock some thread held (logging,
+sqlite, ssl), so workers are not forked from the bot itself: start() forks
+one spawner process while the bot is still single-threaded, and every
+worker, including the replacements, is forked from that spawner.
+
+Metadata (download=False) is cached by normalized URL, so a link posted
+again costs one lookup instead of an extractor run. Its TTL follows the
+expiry of the signed media URLs in it (YouTube's `expire`, Facebook's `oe`,
+CloudFront/S3/Akamai signatures), minus a margin. Permanent failures
+(unsupported link, no media, private or removed video) are cached briefly
+too; throttling and network errors are not. Callers can also remember which of their format strategies
+worked for a site (remember_format/known_format), to skip the ones that
+fail there.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError, ExtractorError, YoutubeDLError
+import yt_dlp.utils
+from shared.cache import ResponseCache
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", 3))
+EXTRACT_TASKS_PER_CHILD = int(os.getenv("EXTRACT_TASKS_PER_CHILD", 50))
+# Seconds an extraction may take, and a download (which includes the extraction)
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", 60))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 600))
+
+EXTRACT_CACHE_ENABLED = os.getenv("EXTRACT_CACHE", "1") != "0"
+# TTL of metadata whose media URLs carry no expiry, and the upper bound for all
+EXTRACT_CACHE_TTL = float(os.getenv("EXTRACT_CACHE_TTL", 6 * 3600))
+EXTRACT_CACHE_MAX_TTL = float(os.getenv("EXTRACT_CACHE_MAX_TTL", 24 * 3600))
+# Links that are not media (or are broken) are not tried again for this long
+EXTRACT_ERROR_TTL = float(os.getenv("EXTRACT_ERROR_TTL", 600))
+# Errors that will come back on a retry; only these are cached. Throttling
+# (HTTP 429), timeouts and other network trouble are not among them.
+PERMANENT_ERROR_PATTERN = re.compile(
+    r"unsupported url|no video formats|no (?:video|media) (?:could be )?found|there's no video|"
+    r"private video|video unavailable|has been removed|no longer available|account (?:has been )?terminated|"
+    r"does not exist|http error 404|http error 410|requested format is not available",
+    re.IGNORECASE,
+)
+# Which format strategy works on a site changes rarely
+FORMAT_MEMORY_TTL = 7 * 24 * 3600
+
+# Query parameters that only track the sharer, never change the media
+TRACKING_PARAMS = {"si", "feature", "igsh", "igshid", "fbclid", "gclid", "ref", "ref_src", "ref_url",
+                   "s", "t", "mibextid", "rdid", "share_url", "app", "pp"}
+HOST_ALIASES = {
+    "twitter.com": "x.com", "mobile.twitter.com": "x.com", "mobile.x.com": "x.com",
+    "fxtwitter.com": "x.com", "vxtwitter.com": "x.com", "fixupx.com": "x.com",
+    "m.youtube.com": "youtube.com", "music.youtube.com": "youtube.com",
+    "m.facebook.com": "facebook.com", "web.facebook.com": "facebook.com",
+    "ddinstagram.com": "instagram.com",
+}
+EXPIRY_PATTERN = re.compile(r"(?:^|[?&/~;]|%26)(?:expire|expires|exp)[=/](\d{10})(?!\d)", re.IGNORECASE)
+
+
+class ExtractionTimeout(DownloadError):
+    """yt-dlp did not finish before the deadline; its worker was killed."""
+
+
+def normalize_url(url: str) -> str:
+    """
+    One spelling for every way a link to the same media is shared.
+
+    Lower-cases the host and drops "www.", maps mirrors (twitter.com,
+    fxtwitter, m.youtube.com, ...) to the canonical site, rewrites youtu.be
+    and Shorts links to watch URLs, and removes fragments, tracking
+    parameters and trailing slashes. Used only for cache keys; yt-dlp
+    still gets the URL as posted.
+    """
+    url = url.strip()
+    parts = urlsplit(url)
+    if not parts.netloc:
+        return url
+    host = parts.hostname or ""
+    if host.startswith("www."):
+        host = host[4:]
+    host = HOST_ALIASES.get(host, host)
+    path = parts.path.rstrip("/") or "/"
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key.lower() not in TRACKING_PARAMS and not key.lower().startswith("utm_")]
+
+    if host == "youtu.be" and path != "/":
+        host, query, path = "youtube.com", [("v", path[1:])] + query, "/watch"
+    elif host == "youtube.com" and path.startswith("/shorts/"):
+        query, path = [("v", path.split("/")[2])] + query, "/watch"
+    elif host == "instagram.com":
+        path = path.replace("/reels/", "/reel/", 1)
+
+    return urlunsplit(("https", host, path, urlencode(sorted(query)), ""))
+
+
+def url_expiry(url: str) -> float:
+    """Epoch seconds at which a signed media URL stops working, or None if it carries no expiry."""
+    params = dict(parse_qsl(urlsplit(url).query))
+    try:
+        if "oe" in params:
+            # Facebook/Instagram CDN: hexadecimal epoch
+            return float(int(params["oe"], 16))
+        if "X-Amz-Date" in params and "X-Amz-Expires" in params:
+            signed = datetime.strptime(params["X-Amz-Date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return signed.timestamp() + float(params["X-Amz-Expires"])
+    except ValueError:
+        pass
+    # YouTube (expire=, or /expire/ in the path), CloudFront (Expires=), Akamai (exp= in a token)
+    match = EXPIRY_PATTERN.search(url)
+    return float(match.group(1)) if match else None
+
+
+def info_ttl(info: dict) -> float:
+    """Seconds the extracted metadata can be reused: until the first of its media URLs expires, less a margin."""
+    urls = []
+    for item in [info] + list(info.get("entries") or []):
+        if not isinstance(item, dict):
+            continue
+        urls.append(item.get("url"))
+        urls += [f.get("url") for f in item.get("requested_formats") or []]
+    expiries = [expiry for expiry in map(url_expiry, filter(None, urls)) if expiry is not None]
+    if not expiries:
+        return EXTRACT_CACHE_TTL
+    remaining = min(expiries) - time.time()
+    # A URL must still work when the message is sent and Telegram/ffmpeg fetch it
+    return min(remaining - max(120.0, remaining * 0.1), EXTRACT_CACHE_MAX_TTL)
+
+
+def _slim(info: dict) -> dict:
+    """info without the bulky fields nobody reads back (subtitles, thumbnails, heatmaps)."""
+    for key in ("automatic_captions", "subtitles", "thumbnails", "heatmap", "_format_sort_fields"):
+        info.pop(key, None)
+    for entry in info.get("entries") or []:
+        if isinstance(entry, dict):
+            _slim(entry)
+    return info
+
+
+def extract(url: str, opts: dict, download: bool = False) -> dict:
+    """
+    YoutubeDL(opts).extract_info(url), reduced to plain data that can cross processes.
+
+    For downloads the info also holds "_filename", the path yt-dlp wrote
+    (before any postprocessor renamed it).
+    """
+    with YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=download)
+        if info is None:
+            return None
+        filename = ydl.prepare_filename(info) if download else None
+        info = _slim(ydl.sanitize_info(info))
+    if filename:
+        info["_filename"] = filename
+    return info
+
+
+def _serve(conn):
+    """Worker process: run (function, args, kwargs) requests from conn until the parent closes it."""
+    # Ctrl+C goes to the parent, which decides when the workers stop; the
+    # own process group lets kill() take any ffmpeg yt-dlp started with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.setpgrp()
+    while True:
+        try:
+            function, args, kwargs = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            conn.send(("ok", function(*args, **kwargs)))
+        except Exception as e:
+            conn.send(("error", type(e).__name__, str(e)))
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """Whether a yt-dlp error is about the link itself (unsupported, no media, private, removed)."""
+    return isinstance(error, yt_dlp.utils.UnsupportedError) or bool(PERMANENT_ERROR_PATTERN.search(str(error)))
+
+
+def _rebuild_error(name: str, message: str) -> Exception:
+    """The exception a worker raised, as the yt-dlp class of that name when there is one."""
+    cls = getattr(yt_dlp.utils, name, None)
+    try:
+        if isinstance(cls, type) and issubclass(cls, ExtractorError):
+            return cls(message, expected=True)
+        if isinstance(cls, type) and issubclass(cls, YoutubeDLError):
+            return cls(message)
+    except TypeError:
+        pass
+    return DownloadError(f"{name}: {message}")
+
+
+def _spawn(conn, parent_conn):
+    """
+    Spawner process: fork a worker for each request on conn.
+
+    Answers with the worker's pid, then passes the parent end of the
+    worker's pipe as a file descriptor.
+    """
+    # The inherited copy of the parent's end would keep conn from ever reaching EOF
+    parent_conn.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Workers are not waited for here; the kernel reaps them when they exit
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    parent_pid = os.getppid()
+    while True:
+        try:
+            conn.recv()
+        except (EOFError, OSError):
+            return
+        worker_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                conn.close()
+                worker_conn.close()
+                # yt-dlp waits for its ffmpeg children, which needs SIGCHLD back
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _serve(child_conn)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        child_conn.close()
+        conn.send(pid)
+        reduction.send_handle(conn, worker_conn.fileno(), parent_pid)
+        worker_conn.close()
+
+
+class _Spawner:
+    """The process workers are forked from; see the module docstring."""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_spawn, args=(child_conn, self.conn), name="yt-dlp-spawner",
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._lock = threading.Lock()
+
+    def spawn(self) -> tuple:
+        """(pid, connection) of a new worker."""
+        with self._lock:
+            self.conn.send(None)
+            pid = self.conn.recv()
+            return pid, Connection(reduction.recv_handle(self.conn))
+
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def close(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+
+
+class _Worker:
+    def __init__(self, spawner: _Spawner):
+        self.pid, self.conn = spawner.spawn()
+        self.calls = 0
+
+    def alive(self) -> bool:
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def kill(self):
+        # The worker leads its own process group, which holds any ffmpeg it started
+        for kill, target in ((os.killpg, self.pid), (os.kill, self.pid)):
+            try:
+                kill(target, signal.SIGKILL)
+                break
+            except (ProcessLookupError, PermissionError):
+                continue
+        self.conn.close()
+
+    def close(self):
+        # Closing the pipe makes the worker's recv() fail, and it exits
+        self.conn.close()
+        deadline = time.monotonic() + 1
+        while self.alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if self.alive():
+            self.kill()
+
+
+class ExtractorPool:
+    """Up to `workers` yt-dlp processes, each replaced after tasks_per_child calls or a missed deadline."""
+
+    def __init__(self, workers: int = EXTRACT_WORKERS, tasks_per_child: int = EXTRACT_TASKS_PER_CHILD):
+        self.workers = workers
+        self.tasks_per_child = tasks_per_child
+        self._context = multiprocessing.get_context("fork")
+        self._spawner = None
+        self._idle = []
+        self._slots = None
+        # Waits on the pipes, one thread per running call
+        self._receiver = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="yt-dlp")
+        self.cache = ResponseCache(memory_entries=256, ttl=EXTRACT_CACHE_TTL, enabled=EXTRACT_CACHE_ENABLED,
+                                   namespace="extract")
+        self.calls = 0
+        self.timeouts = 0
+        self.recycled = 0
+
+    def start(self):
+        """Fork the spawner and the workers now, before the process starts any threads."""
+        while len(self._idle) < self.workers:
+            self._idle.append(self._new_worker())
+
+    def _new_worker(self) -> _Worker:
+        if self._spawner is None or not self._spawner.alive():
+            if self._spawner is not None:
+                logging.error("yt-dlp spawner died, starting a new one")
+                self._spawner.close()
+            self._spawner = _Spawner(self._context)
+        return _Worker(self._spawner)
+
+    async def run(self, function, *args, timeout: float = EXTRACT_TIMEOUT, **kwargs):
+        """
+        function(*args, **kwargs) in a worker process; function must be a module-level function.
+
+        timeout covers waiting for a free worker and the call itself; past it
+        the worker is killed and ExtractionTimeout raised.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        deadline = time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise ExtractionTimeout(f"No yt-dlp worker free within {timeout:g}s")
+        try:
+            return await self._call(function, args, kwargs, deadline, timeout)
+        finally:
+            self._slots.release()
+
+    async def _call(self, function, args, kwargs, deadline: float, timeout: float):
+        worker = self._idle.pop() if self._idle else self._new_worker()
+        if not worker.alive():
+            worker.close()
+            worker = self._new_worker()
+        self.calls += 1
+        worker.calls += 1
+        loop = asyncio.get_running_loop()
+        try:
+            worker.conn.send((function, args, kwargs))
+            reply = await asyncio.wait_for(loop.run_in_executor(self._receiver, worker.conn.recv),
+                                           max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            worker.kill()
+            logging.error(f"yt-dlp worker killed after missing its {timeout:g}s deadline: {function.__name__}{args[:1]}")
+            raise ExtractionTimeout(f"yt-dlp did not finish within {timeout:g}s")
+        except BaseException:
+            # Cancelled caller or broken pipe: the worker may be mid-call, so it cannot be reused
+            worker.kill()
+            raise
+
+        if worker.calls >= self.tasks_per_child:
+            self.recycled += 1
+            # close() may wait up to a second for the worker to exit: let a
+            # thread reap it, without holding up the event loop or this caller
+            loop.run_in_executor(None, worker.close)
+        else:
+            self._idle.append(worker)
+
+        if reply[0] == "ok":
+            return reply[1]
+        raise _rebuild_error(reply[1], reply[2])
+
+    def _info_key(self, url: str, opts: dict) -> str:
+        return self.cache.make_key("yt-dlp", "extract_info", [normalize_url(url), opts])
+
+    def _format_key(self, url: str, purpose: str) -> str:
+        return self.cache.make_key("yt-dlp", "format", [urlsplit(normalize_url(url)).netloc, purpose])
+
+    async def extract_info(self, url: str, opts: dict, download: bool = False, timeout: float = None,
+                           use_cache: bool = True) -> dict:
+        """
+        extract() in a worker; timeout defaults to EXTRACT_TIMEOUT, or DOWNLOAD_TIMEOUT when downloading.
+
+        Metadata-only calls are answered from the cache when the same
+        normalized URL was extracted with the same opts and its media URLs
+        have not expired; a cached failure is raised again.
+        """
+        if timeout is None:
+            timeout = DOWNLOAD_TIMEOUT if download else EXTRACT_TIMEOUT
+        if download or not use_cache:
+            return await self.run(extract, url, opts, download, timeout=timeout)
+
+        key = self._info_key(url, opts)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            entry = json.loads(cached)
+            if "error" in entry:
+                raise _rebuild_error(*entry["error"])
+            return entry["info"]
+
+        try:
+            info = await self.run(extract, url, opts, download, timeout=timeout)
+        except ExtractionTimeout:
+            raise
+        except YoutubeDLError as e:
+            # Links to pages without media fail the same way every time; do
+            # not extract them again right away. Anything else may pass on retry.
+            if is_permanent_error(e):
+                entry = json.dumps({"error": [type(e).__name__, str(e)]})
+                await asyncio.to_thread(self.cache.set, key, entry, EXTRACT_ERROR_TTL)
+            raise
+
+        ttl = info_ttl(info) if info else 0
+        if ttl > 0:
+            await asyncio.to_thread(self.cache.set, key, json.dumps({"info": info}), ttl)
+        return info
+
+    async def forget(self, url: str, opts: dict):
+        """Drop the cached metadata of url, e.g. after its media URL was refused."""
+        await asyncio.to_thread(self.cache.delete, self._info_key(url, opts))
+
+    async def known_format(self, url: str, purpose: str = "default") -> str:
+        """The format strategy remember_format() recorded for url's site, or None."""
+        return await asyncio.to_thread(self.cache.get, self._format_key(url, purpose))
+
+    async def remember_format(self, url: str, name: str, purpose: str = "default"):
+        """Record that the strategy called name works on url's site."""
+        await asyncio.to_thread(self.cache.set, self._format_key(url, purpose), name, FORMAT_MEMORY_TTL)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "idle": len(self._idle), "calls": self.calls,
+                "timeouts": self.timeouts, "recycled": self.recycled}
+
+    def close(self):
+        for worker in self._idle:
+            worker.close()
+        self._idle = []
+        if self._spawner is not None:
+            self._spawner.close()
+            self._spawner = None
+        self._receiver.shutdown(wait=False, cancel_futures=True)
+
+
+EXTRACTOR = ExtractorPool()
@@ -0,0 +1,210 @@
+"""
+Backup, archival and upkeep for messages.db.
+
+Usage (from the repository root):
+    python -m shared.maintenance backup [--dest PATH]
+    python -m shared.maintenance archive [--months N]
+    python -m shared.maintenance optimize [--vacuum]
+    python -m shared.maintenance run
+
+`run` performs every task once per MAINTENANCE_INTERVAL_HOURS, forever.
+The webhook service schedules the same cycle in the background.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+from shared.database import History, archive_name, connect, migrate, to_epoch_ms
+
+BACKUP_DIRNAME = "backups"
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7))
+# Whole months kept in the hot database; older ones move to archive/
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", 6))
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", 24))
+
+
+def _backup_dir(history: History) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(history.db_path)), BACKUP_DIRNAME)
+
+
+def last_backup_time(history: History):
+    """Modification time (epoch seconds) of the newest rotated backup, or None if there is none."""
+    backup_dir = _backup_dir(history)
+    try:
+        names = [name for name in os.listdir(backup_dir) if name.startswith("messages-") and name.endswith(".db")]
+    except FileNotFoundError:
+        return None
+    times = [os.path.getmtime(os.path.join(backup_dir, name)) for name in names]
+    return max(times, default=None)
+
+
+def backup(history: History, dest: str = None, pages: int = 256, sleep: float = 0.05) -> str:
+    """
+    Copy the database to dest with SQLite's online backup API and return the path.
+
+    The copy advances a few pages per step and sleeps between steps, so
+    writers in every service only ever wait for one small step. By default
+    the copy goes to backups/ next to the database and only the newest
+    BACKUP_KEEP copies are kept.
+    """
+    rotate = dest is None
+    backup_dir = _backup_dir(history)
+    if rotate:
+        os.makedirs(backup_dir, exist_ok=True)
+        dest = os.path.join(backup_dir, f"messages-{datetime.now():%Y%m%d-%H%M%S}.db")
+
+    started = time.monotonic()
+    source = connect(history.db_path)
+    target = sqlite3.connect(dest)
+    try:
+        source.backup(target, pages=pages, sleep=sleep)
+    finally:
+        target.close()
+        source.close()
+    logging.info(f"Backed up {history.db_path} to {dest} in {time.monotonic() - started:.1f}s")
+
+    if rotate:
+        backups = sorted(name for name in os.listdir(backup_dir) if name.startswith("messages-") and name.endswith(".db"))
+        for name in backups[:-BACKUP_KEEP]:
+            os.remove(os.path.join(backup_dir, name))
+    return dest
+
+
+def _month_bounds(year: int, month: int) -> tuple:
+    """Epoch milliseconds of the first instant of the month and of the next one (UTC)."""
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return (
+        to_epoch_ms(datetime(year, month, 1, tzinfo=timezone.utc)),
+        to_epoch_ms(datetime(next_year, next_month, 1, tzinfo=timezone.utc)),
+    )
+
+
+def archive(history: History, months: int = ARCHIVE_AFTER_MONTHS) -> int:
+    """
+    Move messages older than the last `months` whole months into monthly archives.
+
+    Each month goes to archive/messages-YYYY-MM.db (same schema, with its own
+    full-text index) in one transaction, so History.search keeps finding it.
+    Rows are copied with INSERT OR IGNORE before they are deleted, so an
+    interrupted run can simply be repeated. Activity rollups stay in the hot
+    database. Returns the number of rows moved.
+    """
+    now = datetime.now(timezone.utc)
+    year, month = divmod(now.year * 12 + now.month - 1 - months, 12)
+    cutoff, _ = _month_bounds(year, month + 1)
+
+    moved = 0
+    conn = connect(history.db_path)
+    try:
+        while True:
+            oldest = conn.execute(
+                "SELECT MIN(created) FROM messages WHERE typeof(created) = 'integer' AND created < ?", (cutoff,)
+            ).fetchone()[0]
+            if oldest is None:
+                break
+
+            oldest_day = datetime.fromtimestamp(oldest / 1000, timezone.utc)
+            start, end = _month_bounds(oldest_day.year, oldest_day.month)
+            os.makedirs(history.archive_dir, exist_ok=True)
+            path = os.path.join(history.archive_dir, archive_name(oldest_day.year, oldest_day.month))
+            # Create or migrate the archive schema on a connection of its own,
+            # not History(path), which would keep one open for the process's life
+            archive_conn = connect(path)
+            try:
+                migrate(archive_conn)
+            finally:
+                archive_conn.close()
+
+            conn.execute("ATTACH DATABASE ? AS archive", (path,))
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO archive.messages SELECT * FROM main.messages WHERE created >= ? AND created < ?",
+                        (start, end),
+                    )
+                    count = conn.execute(
+                        "DELETE FROM main.messages WHERE created >= ? AND created < ?", (start, end)
+                    ).rowcount
+            finally:
+                conn.execute("DETACH DATABASE archive")
+
+            moved += count
+            logging.info(f"Archived {count} messages from {oldest_day:%Y-%m} to {path}")
+    finally:
+        conn.close()
+    return moved
+
+
+def optimize(history: History, vacuum: bool = False):
+    """Merge the full-text index, refresh planner statistics and checkpoint the WAL; VACUUM if asked."""
+    conn = connect(history.db_path)
+    try:
+        with conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        conn.execute("PRAGMA optimize")
+        if vacuum:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    logging.info(f"Optimized {history.db_path}{' and vacuumed' if vacuum else ''}")
+
+
+def run_maintenance(history: History):
+    """One maintenance cycle: backup, archive old months, optimize (and VACUUM if rows moved)."""
+    try:
+        backup(history)
+        moved = archive(history)
+        optimize(history, vacuum=moved > 0)
+    except Exception as e:
+        logging.error(f"Error during database maintenance: {e}")
+
+
+async def maintenance_loop(history: History, interval_hours: float = MAINTENANCE_INTERVAL_HOURS):
+    """
+    Run a maintenance cycle every interval_hours, off the event loop.
+
+    The schedule follows the newest backup on disk, not the process start,
+    so restarts (uvicorn reloads included) never push a cycle back: an
+    overdue cycle runs right away.
+    """
+    while True:
+        last = await asyncio.to_thread(last_backup_time, history)
+        if last is not None:
+            await asyncio.sleep(max(last + interval_hours * 3600 - time.time(), 0))
+        await asyncio.to_thread(run_maintenance, history)
+        if await asyncio.to_thread(last_backup_time, history) == last:
+            # The backup failed; try again after a full interval rather than at once
+            await asyncio.sleep(interval_hours * 3600)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["backup", "archive", "optimize", "run"])
+    parser.add_argument("--db", help="database path (default: shared/messages.db)")
+    parser.add_argument("--dest", help="backup destination file")
+    parser.add_argument("--months", type=int, default=ARCHIVE_AFTER_MONTHS, help="whole months kept in the hot database")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM after optimizing")
+    args = parser.parse_args()
+
+    history = History(args.db)
+    if args.command == "backup":
+        backup(history, args.dest)
+    elif args.command == "archive":
+        archive(history, args.months)
+    elif args.command == "optimize":
+        optimize(history, args.vacuum)
+    else:
+        while True:
+            run_maintenance(history)
+            time.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
+
+
+if __name__ == "__main__":
+    main()
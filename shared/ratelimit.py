@@ -0,0 +1,249 @@
+"""
+Token-bucket rate limits for the model providers.
+
+Every provider/model with a known quota gets a Limiter holding two buckets,
+requests per minute and tokens per minute, refilled continuously. Callers
+that find the buckets empty wait in a queue ordered by priority and then
+arrival, until their deadline. Nobody is turned away while there is quota
+left to spend.
+
+The limits below are the Groq free tier; RATE_LIMITS (JSON, same shape)
+adds or overrides entries, e.g.
+    RATE_LIMITS='{"z_ai/glm-4.6": {"rpm": 60}}'
+Buckets are per process; the Telegram bot is the only service calling the
+providers.
+"""
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+INTERACTIVE, NORMAL, BATCH = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BATCH: "batch"}
+
+DEFAULT_LIMITS = {
+    "groq/llama-3.3-8b-instant": {"rpm": 30, "tpm": 6000},
+    "groq/meta-llama/llama-4-scout-17b-16e-instruct": {"rpm": 30, "tpm": 30000},
+    "groq/whisper-large-v3": {"rpm": 20},
+    "groq/whisper-large-v3-turbo": {"rpm": 20},
+    "groq/distil-whisper-large-v3-en": {"rpm": 20},
+}
+
+# Seconds a caller waits in the queue when its request sets no deadline
+QUEUE_TIMEOUT = float(os.getenv("RATE_LIMIT_QUEUE_TIMEOUT", 30))
+# Completion tokens assumed for a request until the real usage is known
+COMPLETION_TOKENS = int(os.getenv("RATE_LIMIT_COMPLETION_TOKENS", 512))
+
+# (priority, deadline) of the request being served, set by the bot handlers
+# with request_priority() and carried into the AI worker threads
+_request = contextvars.ContextVar("rate_limit_request", default=(NORMAL, None))
+
+
+class QuotaExceeded(Exception):
+    """The quota did not free up before the caller's deadline."""
+
+
+@contextlib.contextmanager
+def request_priority(priority: int, timeout: float = None):
+    """Run the model calls made inside the block at this priority, waiting at most timeout seconds for quota."""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    token = _request.set((priority, deadline))
+    try:
+        yield
+    finally:
+        _request.reset(token)
+
+
+def estimate_tokens(text: str, completion: int = COMPLETION_TOKENS) -> int:
+    """Rough token count of a prompt (about four characters per token) plus the expected answer."""
+    return len(text) // 4 + 1 + completion
+
+
+class TokenBucket:
+    """`per_minute` units, refilled continuously; the balance may go negative after a correction."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount can be taken (requests larger than the bucket wait for a full one)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens -= amount
+
+    def adjust(self, amount: float, now: float):
+        """Charge amount more (or give back, if negative) after the fact."""
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class Limiter:
+    """Request and token buckets for one provider/model, with a priority queue of waiters."""
+
+    def __init__(self, name: str, rpm: float = None, tpm: float = None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.granted = 0
+        self.timed_out = 0
+        # try_acquire() calls that found no quota free; not failures
+        self.skipped = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = 0.0
+        if self.requests:
+            wait = self.requests.wait_time(1, now)
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def acquire(self, tokens: int = 0, priority: int = None, deadline: float = None):
+        """
+        Block until one request and tokens tokens are available, then take them.
+
+        Waiters are served by priority, then in arrival order; only the head
+        of the queue takes quota, so a large request cannot be starved by a
+        stream of small ones. priority and deadline (a time.monotonic()
+        value) default to those set with request_priority(), and the
+        deadline to QUEUE_TIMEOUT seconds from now. Raises QuotaExceeded
+        when the deadline passes first.
+        """
+        context_priority, context_deadline = _request.get()
+        priority = context_priority if priority is None else priority
+        if deadline is None:
+            deadline = context_deadline or time.monotonic() + QUEUE_TIMEOUT
+
+        ticket = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._waiters[0] == ticket:
+                        wait = self._wait_time(tokens, now)
+                        if wait == 0:
+                            if self.requests:
+                                self.requests.take(1, now)
+                            if self.tokens and tokens:
+                                self.tokens.take(tokens, now)
+                            heapq.heappop(self._waiters)
+                            self.granted += 1
+                            return
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise QuotaExceeded(f"{self.name}: quota exhausted")
+                    self._condition.wait(remaining if wait is None else min(wait, remaining))
+            finally:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def try_acquire(self, tokens: int = 0) -> bool:
+        """Take one request and tokens tokens if they are free right now and nobody is waiting; never blocks."""
+        with self._condition:
+            now = time.monotonic()
+            if self._waiters or self._wait_time(tokens, now) > 0:
+                self.skipped += 1
+                return False
+            if self.requests:
+                self.requests.take(1, now)
+            if self.tokens and tokens:
+                self.tokens.take(tokens, now)
+            self.granted += 1
+            return True
+
+    def record_usage(self, estimated: int, actual: int):
+        """Correct the token bucket once the real usage of a request is known."""
+        if self.tokens and actual is not None:
+            with self._condition:
+                self.tokens.adjust(actual - estimated, time.monotonic())
+                self._condition.notify_all()
+
+    def wait_time(self, tokens: int = 0) -> float:
+        """Rough seconds a new request would wait: until quota frees up, plus the queue ahead."""
+        with self._condition:
+            wait = self._wait_time(tokens, time.monotonic())
+            if self.requests and self._waiters:
+                wait += len(self._waiters) / self.requests.rate
+            return wait
+
+    def usage(self) -> dict:
+        with self._condition:
+            now = time.monotonic()
+            usage = {"waiting": len(self._waiters), "granted": self.granted, "timed_out": self.timed_out,
+                     "skipped": self.skipped}
+            for key, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+                if bucket:
+                    bucket._refill(now)
+                    usage[key] = {"available": int(bucket.tokens), "per_minute": int(bucket.capacity)}
+            return usage
+
+
+class RateLimits:
+    """The Limiter of every provider/model with a known quota; calls to the others are not limited."""
+
+    def __init__(self, limits: dict):
+        self.limiters = {
+            name: Limiter(name, limit.get("rpm"), limit.get("tpm"))
+            for name, limit in limits.items()
+        }
+
+    def get(self, provider: str, model: str) -> Optional[Limiter]:
+        return self.limiters.get(f"{provider}/{model}")
+
+    def acquire(self, provider: str, model: str, tokens: int = 0, priority: int = None, deadline: float = None):
+        limiter = self.get(provider, model)
+        if limiter is not None:
+            limiter.acquire(tokens, priority, deadline)
+
+    def try_acquire(self, provider: str, model: str, tokens: int = 0) -> bool:
+        limiter = self.get(provider, model)
+        return limiter.try_acquire(tokens) if limiter is not None else True
+
+    def record_usage(self, provider: str, model: str, estimated: int, actual: int):
+        limiter = self.get(provider, model)
+        if limiter is not None:
+            limiter.record_usage(estimated, actual)
+
+    def wait_time(self, provider: str, model: str, tokens: int = 0) -> float:
+        limiter = self.get(provider, model)
+        return limiter.wait_time(tokens) if limiter is not None else 0.0
+
+    def usage(self) -> dict:
+        return {name: limiter.usage() for name, limiter in self.limiters.items()}
+
+
+def _load_limits() -> dict:
+    limits = dict(DEFAULT_LIMITS)
+    try:
+        limits.update(json.loads(os.getenv("RATE_LIMITS", "{}")))
+    except ValueError as e:
+        logging.error(f"Ignoring invalid RATE_LIMITS: {e}")
+    return limits
+
+
+RATE_LIMITS = RateLimits(_load_limits())
@@ -0,0 +1,306 @@
+"""
+Background jobs for the heavy Telegram tasks: transcriptions, /resume and video links.
+
+Handlers submit a job and return at once. Each kind of job has its own
+small pool of workers, so a burst of links or voice notes waits in a queue
+instead of starting dozens of downloads, ffmpeg runs and API calls at the
+same time. Within a kind, jobs run by priority, then round-robin between
+chats, so one busy chat cannot hold up the others. A chat with the same
+job already queued or running gets that job back rather than a second
+copy.
+
+Every job owns a status message ("Processando...") with a cancel button.
+The job edits it to report progress and, at the end, to show its result.
+Jobs past their kind's timeout are cancelled. Cancelling stops the job at
+its next await; work already handed to a thread (an API call, ffmpeg) runs
+to completion in the background, but its result is dropped.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from shared.ratelimit import NORMAL, request_priority
+
+CANCEL_PREFIX = "cancel_job:"
+# Seconds between two progress edits of the same status message
+PROGRESS_INTERVAL = 2.0
+# Jobs a chat may have queued or running at once
+MAX_JOBS_PER_CHAT = int(os.getenv("MAX_JOBS_PER_CHAT", 5))
+
+
+class JobKind:
+    """A type of job: how many run at once and how long one may take, in seconds."""
+
+    def __init__(self, name: str, workers: int, timeout: float):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+
+
+KINDS = {kind.name: kind for kind in (
+    JobKind("transcribe", int(os.getenv("JOB_WORKERS_TRANSCRIBE", 2)), 600),
+    JobKind("resume", int(os.getenv("JOB_WORKERS_RESUME", 1)), 1200),
+    JobKind("media", int(os.getenv("JOB_WORKERS_MEDIA", 3)), 300),
+)}
+
+
+class Job:
+    """
+    One queued or running task.
+
+    run is an async function called with the job; it reports with
+    progress() and shows its result with finish() (or by editing status
+    itself). It runs under request_priority(priority), so its model calls
+    queue for quota at the same priority.
+    """
+
+    def __init__(self, kind: JobKind, message: types.Message, run, text: str, key=None, priority: int = NORMAL):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.message = message
+        self.chat_id = message.chat.id
+        self.user_id = message.from_user.id if message.from_user else None
+        self.run = run
+        self.text = text
+        self.key = key
+        self.priority = priority
+        self.status: types.Message = None
+        self.state = "queued"
+        self.waited = False
+        self.task: asyncio.Task = None
+        self._last_progress = 0.0
+
+    def keyboard(self):
+        builder = InlineKeyboardBuilder()
+        builder.add(types.InlineKeyboardButton(text="❌ Cancelar", callback_data=f"{CANCEL_PREFIX}{self.id}"))
+        return builder.as_markup()
+
+    async def progress(self, step: str = None, force: bool = False):
+        """Show step under the job's text, keeping the cancel button; edits closer than PROGRESS_INTERVAL are skipped."""
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        await self._edit(f"{self.text}\n{step}" if step else self.text, self.keyboard())
+
+    async def finish(self, text: str):
+        """Replace the status message with text, without the cancel button."""
+        await self._edit(text, None)
+
+    async def clear(self):
+        """Delete the status message, for jobs whose result is a message of its own."""
+        if self.status is None:
+            return
+        try:
+            await self.status.delete()
+        except TelegramBadRequest as e:
+            logging.error(f"Could not delete status of job {self.id}: {e}")
+
+    async def _edit(self, text: str, markup):
+        if self.status is None:
+            return
+        try:
+            await self.status.edit_text(text, reply_markup=markup)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+
+
+class JobQueue:
+    """Per-kind worker pools fed by priority queues that take turns between chats."""
+
+    def __init__(self, kinds: dict = None):
+        self.kinds = kinds or KINDS
+        # kind -> priority -> chat_id -> jobs in arrival order
+        self._pending = {name: {} for name in self.kinds}
+        self._running = {name: 0 for name in self.kinds}
+        self._jobs = {}
+        self._keys = {}
+        self._conditions = {}
+        self._workers = []
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.timed_out = 0
+
+    def _start(self):
+        """Start the workers, on first use (they need the running event loop)."""
+        if self._workers:
+            return
+        for name, kind in self.kinds.items():
+            self._conditions[name] = asyncio.Condition()
+            for index in range(kind.workers):
+                self._workers.append(asyncio.create_task(self._worker(kind), name=f"job-{name}-{index}"))
+
+    def _queued(self, kind: str) -> int:
+        return sum(len(jobs) for chats in self._pending[kind].values() for jobs in chats.values())
+
+    def _pop(self, kind: str) -> Job:
+        queues = self._pending[kind]
+        priority = min(priority for priority, chats in queues.items() if chats)
+        chats = queues[priority]
+        chat_id, jobs = next(iter(chats.items()))
+        job = jobs.popleft()
+        if jobs:
+            # The chat goes to the back of the line for its next job
+            chats.move_to_end(chat_id)
+        else:
+            del chats[chat_id]
+        return job
+
+    def _unqueue(self, job: Job):
+        chats = self._pending[job.kind.name][job.priority]
+        jobs = chats[job.chat_id]
+        jobs.remove(job)
+        if not jobs:
+            del chats[job.chat_id]
+
+    def _forget(self, job: Job):
+        self._jobs.pop(job.id, None)
+        if self._keys.get(job.key) is job:
+            del self._keys[job.key]
+
+    async def submit(self, message: types.Message, kind: str, run, text: str, key=None,
+                     priority: int = NORMAL) -> Job:
+        """
+        Queue run for message and post its status message; returns the job.
+
+        key identifies the work (a file or a URL): while a job with the same
+        key is queued or running in the chat, that job is returned instead.
+        Returns None when the chat already has MAX_JOBS_PER_CHAT jobs.
+        """
+        self._start()
+        job_kind = self.kinds[kind]
+        if key is not None:
+            key = (message.chat.id, kind, key)
+            existing = self._keys.get(key)
+            if existing is not None:
+                await message.reply("⏳ Já estou processando isso.")
+                return existing
+
+        if sum(1 for job in self._jobs.values() if job.chat_id == message.chat.id) >= MAX_JOBS_PER_CHAT:
+            await message.reply("⏳ Muitos pedidos na fila deste chat, tente daqui a pouco.")
+            return None
+
+        job = Job(job_kind, message, run, text, key, priority)
+        self._jobs[job.id] = job
+        if key is not None:
+            self._keys[key] = job
+
+        status_text = text
+        queued = self._queued(kind)
+        if self._running[kind] + queued >= job_kind.workers:
+            job.waited = True
+            status_text += f"\n⏳ Na fila ({queued} à frente)" if queued else "\n⏳ Na fila"
+        try:
+            job.status = await message.reply(status_text, reply_markup=job.keyboard())
+        except Exception:
+            self._forget(job)
+            raise
+
+        condition = self._conditions[kind]
+        async with condition:
+            chats = self._pending[kind].setdefault(priority, OrderedDict())
+            chats.setdefault(job.chat_id, deque()).append(job)
+            condition.notify()
+        return job
+
+    async def _worker(self, kind: JobKind):
+        condition = self._conditions[kind.name]
+        while True:
+            async with condition:
+                await condition.wait_for(lambda: self._queued(kind.name) > 0)
+                job = self._pop(kind.name)
+            await self._run(job)
+
+    async def _run(self, job: Job):
+        kind = job.kind
+        job.state = "running"
+        self._running[kind.name] += 1
+
+        async def body():
+            with request_priority(job.priority):
+                if job.waited:
+                    # Drop the queue position from the status
+                    await job.progress(force=True)
+                await job.run(job)
+
+        job.task = asyncio.create_task(body())
+        try:
+            await asyncio.wait_for(job.task, kind.timeout)
+            job.state = "done"
+            self.completed += 1
+        except asyncio.TimeoutError:
+            job.state = "timed_out"
+            self.timed_out += 1
+            logging.error(f"Job {job.id} ({kind.name}) timed out after {kind.timeout:g}s")
+            await self._finish(job, "⏱️ Demorou demais, desisti.")
+        except asyncio.CancelledError:
+            if job.state != "cancelled":
+                # The worker itself is shutting down
+                raise
+            self.cancelled += 1
+            await self._finish(job, "🚫 Cancelado.")
+        except Exception as e:
+            job.state = "failed"
+            self.failed += 1
+            logging.error(f"Job {job.id} ({kind.name}) failed: {e}")
+            await self._finish(job, "❌ Ocorreu um erro ao processar.")
+        finally:
+            self._running[kind.name] -= 1
+            self._forget(job)
+
+    async def _finish(self, job: Job, text: str):
+        try:
+            await job.finish(text)
+        except Exception as e:
+            logging.error(f"Could not update status of job {job.id}: {e}")
+
+    async def cancel(self, job_id: str, user_id: int = None) -> str:
+        """Cancel a job for whoever asked for it; returns the answer for the cancel button."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return "Esse pedido já terminou."
+        if job.user_id is not None and user_id != job.user_id:
+            return "Só quem pediu pode cancelar."
+
+        if job.state == "queued":
+            self._unqueue(job)
+            job.state = "cancelled"
+            self.cancelled += 1
+            self._forget(job)
+            await self._finish(job, "🚫 Cancelado.")
+        else:
+            job.state = "cancelled"
+            job.task.cancel()
+        return "Cancelado."
+
+    def stats(self) -> dict:
+        return {
+            "kinds": {
+                name: {"workers": kind.workers, "running": self._running[name], "queued": self._queued(name)}
+                for name, kind in self.kinds.items()
+            },
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "timed_out": self.timed_out,
+        }
+
+    async def close(self):
+        """Stop the workers, cancelling running jobs; queued jobs are dropped."""
+        for job in list(self._jobs.values()):
+            if job.task is not None:
+                job.task.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+JOBS = JobQueue()
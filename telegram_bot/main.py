@@ -1,19 +1,27 @@
 import asyncio
+import functools
+import html
 import json
 import logging
 import os
 import random
+import re
 import sys
 import os.path
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, Router, F
 from aiogram.filters import Command, CommandObject
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramAPIError
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from instant_view import generate_telegraph, init_telegraph
-from shared.ai_tools import Z_AI_API
-from utils import transcribe_media, send_image_with_button, send_media_stream, is_valid_link, VideoNotFound, process_youtube_video
-from shared.database import History
+from shared.ai_tools import LLM_ROUTER, RESPONSE_CACHE, run_blocking
+from shared.ratelimit import RATE_LIMITS, INTERACTIVE, BATCH, request_priority
+from shared.extractor import EXTRACTOR, normalize_url
+from jobs import JOBS, CANCEL_PREFIX
+from utils import transcribe_media, send_image_with_button, send_media_stream, send_known_media, is_valid_link, VideoNotFound, transcribe_youtube_video, summarize_transcription, stream_reply, reply_answer
+from shared.database import AsyncHistory, from_epoch_ms
 
 load_dotenv()
 
@@ -23,6 +31,9 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_USERS_FILE = os.path.join(os.path.dirname(__file__), "allowed_users.json")
 router = Router()
 
+# Shared history handle; calls run on a database thread, off the event loop
+history = AsyncHistory()
+
 
 def load_allowed_users():
     """Load the list of allowed users from JSON file."""
@@ -60,7 +71,7 @@ async def cmd_image(message: types.Message, command: CommandObject):
         await message.reply("Por favor, forneça uma consulta para a imagem. Exemplo: /image cachorro")
         return
     response = await send_image_with_button(message, command.args)
-    save_message_to_history(message, message.bot)
+    await save_message_to_history(message, message.bot)
 
 
 @router.message(Command("add_user"))
@@ -158,44 +169,92 @@ async def cmd_resume(message: types.Message, command: CommandObject):
         await message.reply("Por favor, forneça um link válido do YouTube.")
         return
 
+    # Long videos run in the background and wait for quota behind mentions and /tldr
+    await JOBS.submit(
+        message, "resume", functools.partial(resume_job, url=command.args),
+        "Processando seu vídeo...", key=command.args, priority=BATCH,
+    )
+    await save_message_to_history(message, message.bot)
+
+
+async def resume_job(job, url: str):
+    """Transcribe and summarize a YouTube video, streaming the summary into the job's status message."""
     try:
-        # Process the YouTube video
-        processing_message = await message.reply("Processando seu vídeo...")
-        summary = await process_youtube_video(command.args)
-        await processing_message.edit_text(f"📝 <b>Resumo do vídeo:</b>\n\n{summary}", parse_mode="HTML")
-        save_message_to_history(message, message.bot)
+        await job.progress("⬇️ Baixando o áudio...", force=True)
+        transcription = await transcribe_youtube_video(url, progress=functools.partial(job.progress, force=True))
+        await stream_reply(
+            job.message,
+            summarize_transcription(transcription),
+            edit=job.status,
+            header="📝 <b>Resumo do vídeo:</b>\n\n",
+        )
     except Exception as e:
         logging.error(f"Error processing YouTube video: {e}")
-        await message.reply("Desculpe, ocorreu um erro ao processar o vídeo.")
+        await job.finish("Desculpe, ocorreu um erro ao processar o vídeo.")
+
+
+# Most recent messages a time-window /tldr reads
+TLDR_WINDOW_LIMIT = 1000
+
+TIME_WINDOW_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+
+def parse_time_window(arg: str):
+    """
+    Parse '30m', '2h', '3d', '1w', 'today'/'hoje', 'week'/'semana' or
+    'month'/'mes' into a start datetime, or None if arg is not a window.
+    """
+    arg = arg.strip().lower()
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if arg in ("today", "hoje"):
+        return midnight
+    if arg in ("week", "semana"):
+        return midnight - timedelta(days=midnight.weekday())
+    if arg in ("month", "mes", "mês"):
+        return midnight.replace(day=1)
+
+    match = re.fullmatch(r"(\d+)\s*([mhdw])", arg)
+    if not match:
+        return None
+    amount, unit = int(match.group(1)), TIME_WINDOW_UNITS[match.group(2)]
+    return datetime.now() - timedelta(**{unit: amount})
+
+
+def format_created(created, fmt: str = '%d/%m %H:%M') -> str:
+    """Format a messages.created value (epoch milliseconds)."""
+    try:
+        return from_epoch_ms(created).strftime(fmt)
+    except (TypeError, ValueError, OverflowError):
+        return str(created)[:16] if created else "Unknown"
 
 
 @router.message(Command("tldr"))
 async def cmd_tldr(message: types.Message, command: CommandObject):
     try:
-        # Get message limit (default 100)
-        if command.args and command.args.strip():
-            try:
-                limit = int(command.args.strip())
-            except ValueError:
-                await message.reply("❌ Número inválido. Use: /tldr ou /tldr [número]")
-                return
-
-            if limit > 300:
-                await message.reply("Tu ta muito engraçado, palhaço gozadola.. Gustavo tem fimose. Limite de 300")
-                return
-        else:
-            limit = 100
+        # Either a message count (default 100) or a time window like 2h / today
+        arg = command.args.strip() if command.args else ""
+        since = None
+        limit = 100
+        if arg:
+            since = parse_time_window(arg)
+            if since is None:
+                try:
+                    limit = int(arg)
+                except ValueError:
+                    await message.reply("❌ Argumento inválido. Use: /tldr, /tldr [número], /tldr 2h ou /tldr today")
+                    return
+
+                if limit > 300:
+                    await message.reply("Tu ta muito engraçado, palhaço gozadola.. Gustavo tem fimose. Limite de 300")
+                    return
 
-        # Get message limit (default 100)
-        limit = int(command.args) if command.args and command.args.isdigit() else 100
         processing_message = await message.reply("🔄 Analisando mensagens...")
 
-        history = History()
-        if not history:
-            await processing_message.edit_text("❌ Erro ao acessar histórico de mensagens.")
-            return
-
-        messages = history.get_all_messages(limit)
+        chat_id = str(message.chat.id)
+        if since is not None:
+            messages = await history.get_messages_between(since, limit=TLDR_WINDOW_LIMIT, chat_id=chat_id)
+        else:
+            messages = await history.get_all_messages(limit, chat_id=chat_id)
 
         if not messages:
             await processing_message.edit_text("❌ Não há mensagens no histórico.")
@@ -210,25 +269,23 @@ async def cmd_tldr(message: types.Message, command: CommandObject):
 
         # Generate AI summary
         prompt = f"Faça um resumo conciso das principais discussões desta conversa em português:\n\n{conversation} Retorne sem tags HTML."
-        if LM_STUDIO_API.is_avaiable():
-            summary = LM_STUDIO_API.chat(prompt)
-        else:
-            summary = GROQ_API.chat(prompt)
+        chunks = LLM_ROUTER.astream_chat(prompt)
+
+        # The summary is shown as it is generated; past Telegram's 4096
+        # characters it continues in another message
+        summary = await stream_reply(
+            message,
+            chunks,
+            edit=processing_message,
+            header="📝 <b>Resumo da conversa:</b>\n\n",
+            footer=format_tldr_stats(stats),
+        )
 
         if not summary or summary.strip() == "":
             await processing_message.edit_text("❌ Erro ao gerar resumo com IA.")
             return
 
-        # Format response with statistics
-        stats_text = format_tldr_stats(stats)
-        response = f"📝 <b>Resumo da conversa:</b>\n\n{summary}{stats_text}"
-
-        # Telegram message limit is 4096 characters
-        if len(response) > 4000:
-            response = response[:3900] + "...\n\n[Mensagem truncada]"
-
-        await processing_message.edit_text(response, parse_mode="HTML")
-        save_message_to_history(message, message.bot)
+        await save_message_to_history(message, message.bot)
 
     except Exception as e:
         logging.error(f"Error generating TLDR: {e}")
@@ -261,9 +318,9 @@ def prepare_messages_for_tldr(messages, max_chars=4000):
             stats['media_ignored'] += 1
             continue
 
-        # Database schema: id, user, message_id, text, replied_to, from_bot, kind, created
+        # Database schema: id, user, message_id, text, replied_to, from_bot, kind, created, chat_id
         # Skip the id field and unpack the rest
-        _, user, message_id, text, replied_to, from_bot, kind, created = msg
+        _, user, message_id, text, replied_to, from_bot, kind, created = msg[:8]
 
         # Skip if it's from a bot
         if from_bot:
@@ -363,23 +420,113 @@ def format_tldr_stats(stats):
 
     if stats['oldest_message']:
         user, created = stats['oldest_message']
-        # Format timestamp more readably
-        from datetime import datetime
-        try:
-            # Handle different timestamp formats
-            if 'T' in created:
-                dt = datetime.fromisoformat(created.replace('Z', '+00:00'))
-            else:
-                dt = datetime.strptime(created, '%Y-%m-%d %H:%M:%S')
-            formatted_time = dt.strftime('%d/%m %H:%M')
-        except Exception:
-            # Fallback to raw timestamp if parsing fails
-            formatted_time = str(created)[:16] if created else "Unknown"
+        formatted_time = format_created(created)
         stats_text += f"• Resumo desde: {formatted_time} ({user})"
 
     return stats_text
 
 
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message, command: CommandObject):
+    """Who talked the most in a period. Usage: /stats [today|week|month|7d] (default: month)"""
+    arg = command.args.strip() if command.args else "month"
+    since = parse_time_window(arg)
+    if since is None:
+        await message.reply("❌ Período inválido. Use: /stats, /stats today, /stats week, /stats month ou /stats 7d")
+        return
+
+    try:
+        activity = await history.get_activity(since, limit=10, chat_id=str(message.chat.id))
+    except Exception as e:
+        logging.error(f"Error reading activity stats: {e}")
+        await message.reply("❌ Erro ao ler as estatísticas.")
+        return
+
+    if not activity:
+        await message.reply("📊 Nenhuma mensagem nesse período.")
+        return
+
+    lines = [f"📊 <b>Atividade desde {since.strftime('%d/%m')}:</b>\n"]
+    for position, (user, msg_count, char_count) in enumerate(activity, 1):
+        lines.append(f"{position}. {html.escape(user)}: {msg_count} msgs, {char_count} chars")
+
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("quota"))
+async def cmd_quota(message: types.Message):
+    """Rate-limit quota left per model, provider health, background jobs and cache hits."""
+    lines = ["📈 <b>Cota por modelo (por minuto):</b>\n"]
+    for name, usage in RATE_LIMITS.usage().items():
+        parts = []
+        for key, label in (("requests", "req"), ("tokens", "tokens")):
+            if key in usage:
+                parts.append(f"{usage[key]['available']}/{usage[key]['per_minute']} {label}")
+        if usage["waiting"]:
+            parts.append(f"{usage['waiting']} na fila")
+        if usage["timed_out"]:
+            parts.append(f"{usage['timed_out']} desistiram")
+        if usage["skipped"]:
+            parts.append(f"{usage['skipped']} pulados")
+        lines.append(f"• {html.escape(name)}: {', '.join(parts)}")
+
+    router_stats = LLM_ROUTER.stats()
+    lines.append("\n🤖 <b>Provedores:</b>\n")
+    for name, backend in router_stats["backends"].items():
+        latency = backend["latency_p50"]
+        latency_text = f"{latency:.1f}s" if latency is not None else "?"
+        status = "fora do ar" if not backend["healthy"] else f"circuito {backend['circuit']}"
+        lines.append(f"• {name}: {status}, p50 {latency_text}, erros {backend['error_rate']:.0%}")
+    lines.append(f"• hedges: {router_stats['hedges']} ({router_stats['hedge_wins']} ganharam)")
+
+    job_stats = JOBS.stats()
+    lines.append("\n⚙️ <b>Tarefas:</b>\n")
+    for name, kind in job_stats["kinds"].items():
+        lines.append(f"• {name}: {kind['running']}/{kind['workers']} rodando, {kind['queued']} na fila")
+    lines.append(f"• {job_stats['completed']} concluídas, {job_stats['failed']} falharam, "
+                 f"{job_stats['cancelled']} canceladas, {job_stats['timed_out']} expiraram")
+
+    cache = await run_blocking(RESPONSE_CACHE.stats)
+    lines.append(f"\n💾 <b>Cache:</b> {cache['hits']} acertos, {cache['misses']} faltas, {cache['entries']} respostas")
+
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("search"))
+async def cmd_search(message: types.Message, command: CommandObject):
+    """Full-text search over the chat history. Usage: /search [@usuario] termos"""
+    args = (command.args or "").split()
+    user = None
+    if args and args[0].startswith('@'):
+        user = args.pop(0).lstrip('@')
+
+    query = " ".join(args)
+    if not query:
+        await message.reply("Por favor, forneça os termos da busca. Exemplo: /search pizza ou /search @usuario pizza")
+        return
+
+    try:
+        # Highlight with markers that survive html.escape, then swap them for tags
+        results = await history.search(query, user=user, limit=10, highlight=("\x02", "\x03"),
+                                       chat_id=str(message.chat.id))
+    except Exception as e:
+        logging.error(f"Error searching history: {e}")
+        await message.reply("❌ Erro ao buscar no histórico.")
+        return
+
+    if not results:
+        await message.reply("🔍 Nenhuma mensagem encontrada.")
+        return
+
+    lines = [f"🔍 <b>Resultados para:</b> {html.escape(query)}\n"]
+    for row in results:
+        user_name, created, snippet = row[1], row[7], row[-1]
+        snippet = html.escape(snippet).replace("\x02", "<b>").replace("\x03", "</b>")
+        lines.append(f"• <b>{html.escape(user_name)}</b> ({format_created(created, '%d/%m/%y %H:%M')}): {snippet}")
+
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
+
 @router.message(F.text.contains('@') | F.caption.contains('@'))
 async def mention_handler(message: types.Message):
     # Only respond to allowed users
@@ -401,7 +548,7 @@ async def mention_handler(message: types.Message):
         question = message_text.replace(f"@{bot_username}", "").strip()
 
         # Check for images and prepare context
-        image_url = None
+        image = None
         context_parts = []
 
         # Check if this is a reply to another message
@@ -416,33 +563,43 @@ async def mention_handler(message: types.Message):
             # Check for image in the replied message
             if replied_msg.photo:
                 # Get the largest photo
-                photo = replied_msg.photo[-1]
-                file = await message.bot.get_file(photo.file_id)
-                image_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+                image = replied_msg.photo[-1]
             elif replied_msg.document and replied_msg.document.mime_type and replied_msg.document.mime_type.startswith('image/'):
-                file = await message.bot.get_file(replied_msg.document.file_id)
-                image_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+                image = replied_msg.document
         else:
             context_parts.append(f"Pergunta de {message.from_user.username}: {question}")
 
             # Check for image in the current message
             if message.photo:
-                photo = message.photo[-1]
-                file = await message.bot.get_file(photo.file_id)
-                image_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+                image = message.photo[-1]
             elif message.document and message.document.mime_type and message.document.mime_type.startswith('image/'):
-                file = await message.bot.get_file(message.document.file_id)
-                image_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+                image = message.document
 
         # Build the final prompt
         prompt = "\n".join(context_parts) if context_parts else question
 
-        # Call Z_AI with or without image
-        response = Z_AI_API.chat(prompt, image_url=image_url)
+        # A reposted image is answered from the cache, before any download
+        image_id = image.file_unique_id if image else None
+        response = await LLM_ROUTER.acached_chat(prompt, image_id) if image else None
+
+        if response is None:
+            image_url = None
+            if image:
+                file = await message.bot.get_file(image.file_id)
+                image_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+
+            # The router picks the fastest healthy model that handles the
+            # image, if any, and hedges with a second one when it straggles;
+            # the reply grows as the answer streams in
+            with request_priority(INTERACTIVE):
+                response = await stream_reply(
+                    message, LLM_ROUTER.astream_chat(prompt, image_url=image_url, image_id=image_id, hedge=True)
+                )
+        else:
+            await reply_answer(message, response)
 
         logging.info(f"Mention response: {response}")
-        await message.reply(response)
-        save_message_to_history(message, message.bot)
+        await save_message_to_history(message, message.bot)
 
     except Exception as e:
         logging.error(f"Error processing mention: {e}")
@@ -456,31 +613,31 @@ async def callback_another_image(callback: types.CallbackQuery):
     await send_image_with_button(callback.message, query)
     # Answer the callback query to remove the loading state
     await callback.answer()
-    save_message_to_history(callback.message, callback.message.bot)
+    await save_message_to_history(callback.message, callback.message.bot)
 
 
 @router.message(F.video)
 async def video_handler(message: types.Message, bot: Bot):
-    await transcribe_media(message, bot, "video", message.video.file_id, "mp4")
-    save_message_to_history(message, bot)
+    await transcribe_media(message, bot, "video", message.video.file_id, "mp4", message.video.file_unique_id)
+    await save_message_to_history(message, bot)
 
 
 @router.message(F.video_note)
 async def video_note_handler(message: types.Message, bot: Bot):
-    await transcribe_media(message, bot, "video_note", message.video_note.file_id, "mp4")
-    save_message_to_history(message, bot)
+    await transcribe_media(message, bot, "video_note", message.video_note.file_id, "mp4", message.video_note.file_unique_id)
+    await save_message_to_history(message, bot)
 
 
 @router.message(F.audio)
 async def audio_handler(message: types.Message, bot: Bot):
-    await transcribe_media(message, bot, "audio", message.audio.file_id, "mp3")
-    save_message_to_history(message, bot)
+    await transcribe_media(message, bot, "audio", message.audio.file_id, "mp3", message.audio.file_unique_id)
+    await save_message_to_history(message, bot)
 
 
 @router.message(F.voice)
 async def voice_handler(message: types.Message, bot: Bot):
-    await transcribe_media(message, bot, "voice", message.voice.file_id, "ogg")
-    save_message_to_history(message, bot)
+    await transcribe_media(message, bot, "voice", message.voice.file_id, "ogg", message.voice.file_unique_id)
+    await save_message_to_history(message, bot)
 
 
 @router.message(F.text)
@@ -503,30 +660,52 @@ async def text_handler(message: types.Message, bot: Bot):
     if random.random() < 0.05:
         await message.reply_photo(random.choice(random_reply_images))
 
-    save_message_to_history(message, bot)
+    await save_message_to_history(message, bot)
 
     if len(message.text.split(' ')) > 1:
         return
 
     logging.info(f"IsValidLink: {is_valid_link(message.text)}")
+    if 'https://' in message.text and is_valid_link(message.text):
+        # A link sent before goes out again by file_id, without yt-dlp or a job
+        url = normalize_url(message.text)
+        known = await history.get_media_file(url)
+        if known is not None:
+            try:
+                if await send_known_media(message, known):
+                    await history.media_file_sent(url)
+                    return
+                # Telegram refused the file_id: fetch the link again
+                await history.delete_media_file(url)
+            except TelegramAPIError as e:
+                # Not the file_id's fault (network, flood wait, ...): keep it, but still answer
+                logging.error(f"Could not resend {known['file_id']} for {message.text}: {e}")
+        await JOBS.submit(message, "media", functools.partial(media_job, message=message, url=url),
+                          "⬇️ Baixando...", key=message.text)
+
+
+async def media_job(job, message: types.Message, url: str):
+    """Send the video behind a link and remember its file_id; the status message goes away once it is sent."""
     try:
-        if 'https://' in message.text and is_valid_link(message.text):
-            await send_media_stream(message)
-
+        sent = await send_media_stream(message)
+        if sent is not None:
+            await history.save_media_file(url, sent["file_id"], sent["kind"], sent["title"], sent["file_unique_id"])
     except VideoNotFound as e:
         if 'https://x.com/' in message.text and '/status/' in message.text:
-            url = await generate_telegraph(message.text)
-            await message.reply(url)
+            telegraph_url = await generate_telegraph(message.text)
+            await message.reply(telegraph_url)
+    await job.clear()
 
 
-def save_message_to_history(message: types.Message, bot: Bot) -> None:
+@router.callback_query(F.data.startswith(CANCEL_PREFIX))
+async def callback_cancel_job(callback: types.CallbackQuery):
+    answer = await JOBS.cancel(callback.data[len(CANCEL_PREFIX):], callback.from_user.id)
+    await callback.answer(answer)
+
+
+async def save_message_to_history(message: types.Message, bot: Bot) -> None:
     """Save all messages to the history database."""
     try:
-        history = History()
-        if not history:
-            logging.error("Failed to initialize History database")
-            return
-
         # Determine if the message is from the bot itself
         from_bot = message.from_user.id == bot.id if message.from_user else False
 
@@ -552,25 +731,41 @@ def save_message_to_history(message: types.Message, bot: Bot) -> None:
         elif message.video_note:
             kind = "video_note"
 
-        # Save the message to the database
-        history.save_message(
+        row = dict(
             user=str(message.from_user.username or message.from_user.id) if message.from_user else "Unknown",
             message_id=str(message.message_id),
             text=message.text or "",
             replied_to=replied_to,
             from_bot=from_bot,
-            kind=kind
+            kind=kind,
+            chat_id=str(message.chat.id)
         )
-        logging.info(f"Message {message.message_id} saved to history")
+        # Queue the message for the background writer, which commits in batches
+        if await history.enqueue_message(**row):
+            logging.info(f"Message {message.message_id} queued for history")
+            return
+        # The writer is far behind: write this one directly rather than lose it
+        logging.warning(f"History queue full, saving message {message.message_id} of chat {message.chat.id} directly")
+        await history.save_message(**row)
     except Exception as e:
         logging.error(f"Error saving message to history: {e}")
 
 
+async def on_shutdown():
+    """Stop the background jobs and yt-dlp workers, and write any history rows still waiting in the write-behind queue."""
+    await JOBS.close()
+    EXTRACTOR.close()
+    await history.close_writer()
+
+
 async def main():
+    # Fork the yt-dlp workers before the bot starts its own threads
+    EXTRACTOR.start()
     await init_telegraph()
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
     dp = Dispatcher()
     dp.include_router(router)
+    dp.shutdown.register(on_shutdown)
     await dp.start_polling(bot)
 
 
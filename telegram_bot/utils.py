@@ -1,26 +1,171 @@
 import os
+import html
+import time
 import uuid
+import asyncio
+import functools
 import logging
+from typing import Optional
 from aiogram import types, Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import LinkPreviewOptions
-from shared.ai_tools import GROQ_API, GOOGLE_IMAGE_API
+from shared.ai_tools import GROQ_API, GOOGLE_IMAGE_API, LLM_ROUTER
+from shared.audio import SPOOL_DIR, spooled
+from shared.ratelimit import INTERACTIVE, NORMAL
+from jobs import JOBS
 from yt_dlp.utils import ExtractorError, DownloadError
-from yt_dlp import YoutubeDL
+from shared.extractor import EXTRACTOR
 
 class VideoNotFound(Exception):
     pass
 
-async def transcribe_media(message: types.Message, bot: Bot, media_type: str, file_id: str, file_extension: str):
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Seconds between edits of a streamed answer; Telegram allows roughly one
+# edit per second per chat before answering 429
+STREAM_EDIT_INTERVAL = 1.5
+STREAM_CURSOR = " ▌"
+# Media up to this size is downloaded into memory; larger files (only
+# possible with a local Bot API server) are spooled to tmpfs
+MEDIA_MEMORY_LIMIT = int(os.getenv("MEDIA_MEMORY_LIMIT", 20 * 1024 * 1024))
+
+YOUTUBE_SUMMARY_PROMPT = "Você é uma ferramenta de resumir e summarizar conteúdos, retorne o resumo do que foi dito nesse video.. seja breve mas consiso. Responda apenas em texto.. NOT ALLOWED MARKDOWN AND HTML"
+
+
+async def _show_stream(message: types.Message, target, header: str, body: str, footer: str, final: bool):
+    """
+    Send or edit one message of a streamed answer and return it.
+
+    While streaming the body is escaped, since half-written HTML would be
+    rejected; the final edit renders it as HTML and falls back to escaped
+    text if Telegram cannot parse it.
+    """
+    rendered_body = body if final else html.escape(body) + STREAM_CURSOR
+    text = header + rendered_body + footer
+    try:
+        if target is None:
+            return await message.reply(text)
+        await target.edit_text(text)
+    except TelegramRetryAfter as e:
+        if not final:
+            return target  # skip this frame, the next one catches up
+        await asyncio.sleep(e.retry_after)
+        return await _show_stream(message, target, header, body, footer, final)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return target
+        if final and body and html.escape(body) != body:
+            return await _show_stream(message, target, header, html.escape(body), footer, final)
+        raise
+    return target
+
+
+def _split_point(text: str, budget: int) -> int:
+    """Longest prefix of text whose escaped length fits budget, cut at a line break or space if possible."""
+    used = 0
+    end = 0
+    for end, char in enumerate(text):
+        used += len(html.escape(char))
+        if used > budget:
+            break
+    else:
+        return len(text)
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, 0, end)
+        if cut > end // 2:
+            return cut + 1
+    return end
+
+
+def message_parts(body: str, header: str = "") -> list:
+    """body (plain text) escaped for HTML and split into Telegram-sized messages, the first one starting with header."""
+    parts = []
+    budget = TELEGRAM_MESSAGE_LIMIT - len(header)
+    while True:
+        cut = _split_point(body, budget)
+        parts.append(header + html.escape(body[:cut]))
+        body = body[cut:]
+        if not body:
+            return parts
+        header, budget = "", TELEGRAM_MESSAGE_LIMIT
+
+
+async def reply_parts(message: types.Message, parts: list) -> types.Message:
+    """Send parts as a chain of replies, each answering the previous one, starting at message; returns the last."""
+    for part in parts:
+        message = await message.reply(part)
+    return message
+
+
+async def stream_reply(message: types.Message, chunks, edit: types.Message = None, header: str = "",
+                       footer: str = "", interval: float = STREAM_EDIT_INTERVAL) -> str:
+    """
+    Show a streamed model answer by editing a Telegram message as chunks arrive.
+
+    Args:
+        message: The message to reply to
+        chunks: Async iterable of text pieces (a provider's astream_chat)
+        edit: Message to edit, such as a "Processando..." notice; if None the
+            first chunk is sent as a reply to message
+        header: HTML shown before the answer in the first message
+        footer: HTML shown after the answer in the last message
+        interval: Minimum seconds between edits; chunks arriving in between
+            are coalesced into the next edit
+
+    Answers longer than one Telegram message continue in further replies.
+    Returns the full answer.
+    """
+    parts = []
+    pending = ""
+    last_edit = 0.0
+    async for chunk in chunks:
+        parts.append(chunk)
+        pending += chunk
+
+        budget = TELEGRAM_MESSAGE_LIMIT - len(header) - len(footer) - len(STREAM_CURSOR)
+        while len(html.escape(pending)) > budget:
+            cut = _split_point(pending, budget)
+            edit = await _show_stream(message, edit, header, pending[:cut], "", final=True)
+            message, edit, header, pending = edit, None, "", pending[cut:]
+            budget = TELEGRAM_MESSAGE_LIMIT - len(footer) - len(STREAM_CURSOR)
+
+        if pending.strip() and time.monotonic() - last_edit >= interval:
+            edit = await _show_stream(message, edit, header, pending, "", final=False)
+            last_edit = time.monotonic()
+
+    if pending.strip() or header or footer:
+        await _show_stream(message, edit, header, pending, footer, final=True)
+    return "".join(parts)
+
+
+async def reply_answer(message: types.Message, answer: str, edit: types.Message = None) -> str:
+    """
+    Send a complete model answer (a cached one, say) exactly as stream_reply would show it.
+
+    Same HTML rendering, plain-text fallback and 4096-character split; there
+    are just no intermediate edits.
+    """
+    async def whole():
+        yield answer
+
+    return await stream_reply(message, whole(), edit, interval=float("inf"))
+
+async def transcribe_media(message: types.Message, bot: Bot, media_type: str, file_id: str, file_extension: str,
+                           file_unique_id: str = None):
     """
     Generic function to handle media transcription
 
+    Cached transcriptions are answered at once; anything else is queued as a
+    "transcribe" job, which downloads and transcribes the file in the background.
+
     Args:
         message: The Telegram message object
         bot: The Telegram bot instance
         media_type: Type of media (voice, video, audio, video_note)
         file_id: Telegram file ID
         file_extension: File extension for saving
+        file_unique_id: Telegram's stable file ID, used to answer reposted media from the cache
     """
     # Define messages based on media type
     messages = {
@@ -33,21 +178,51 @@ async def transcribe_media(message: types.Message, bot: Bot, media_type: str, fi
     # Get appropriate messages
     processing_msg, response_template = messages.get(media_type, ("Processing...", "{}"))
 
-    # Send processing message and keep a reference to it
-    processing_message = await message.reply(processing_msg)
-
-    # Download the media file
-    file = await bot.get_file(file_id)
-    file_path = file.file_path
-    file_name = f"{media_type}_{message.message_id}.{file_extension}"
-
-    await bot.download_file(file_path, file_name)
-    logging.info(f"Downloaded {media_type} file: {file_name}")
+    # Reposted or forwarded media was already transcribed: skip the download
+    if file_unique_id:
+        transcription = await GROQ_API.acached_transcription(file_unique_id)
+        if transcription is not None:
+            await reply_parts(message, message_parts(transcription, response_template.format("")))
+            return
+
+    # Voice notes are answered before longer uploads waiting for a worker
+    priority = INTERACTIVE if media_type in ("voice", "video_note") else NORMAL
+    await JOBS.submit(
+        message, "transcribe",
+        functools.partial(_transcribe_media_job, bot=bot, media_type=media_type, file_id=file_id,
+                          file_extension=file_extension, file_unique_id=file_unique_id,
+                          response_template=response_template),
+        processing_msg, key=file_unique_id or file_id, priority=priority,
+    )
+
+
+async def _transcribe_media_job(job, bot: Bot, media_type: str, file_id: str, file_extension: str,
+                                file_unique_id: str, response_template: str):
+    """Download and transcribe the media of a transcribe_media() job, reporting progress in its status message."""
     try:
-        transcription = GROQ_API.transcribe_audio(file_name)
-
-        await processing_message.edit_text(response_template.format(transcription))
+        # Download the media file into memory, or into tmpfs when it is too large
+        await job.progress("⬇️ Baixando...", force=True)
+        file = await bot.get_file(file_id)
+        file_name = f"{media_type}.{file_extension}"
+        if file.file_size is not None and file.file_size > MEDIA_MEMORY_LIMIT:
+            with spooled(suffix=f".{file_extension}") as path:
+                await bot.download_file(file.file_path, path)
+                logging.info(f"Downloaded {media_type} file to {path} ({file.file_size} bytes)")
+                await job.progress("✍️ Transcrevendo...", force=True)
+                transcription = await GROQ_API.atranscribe_audio(path, file_unique_id, filename=file_name)
+        else:
+            buffer = await bot.download_file(file.file_path)
+            audio = buffer.getvalue()
+            logging.info(f"Downloaded {media_type} file into memory ({len(audio)} bytes)")
+            await job.progress("✍️ Transcrevendo...", force=True)
+            transcription = await GROQ_API.atranscribe_audio(audio, file_unique_id, filename=file_name)
+
+        # An hour-long recording does not fit one message: the rest follows in replies
+        first, *rest = message_parts(transcription, response_template.format(""))
+        await job.finish(first)
+        await reply_parts(job.status or job.message, rest)
     except Exception as e:
+        logging.error(f"Error transcribing {media_type}: {e}")
         # Define error messages based on media type
         error_messages = {
             "video": "❌ Não foi possível transcrever o áudio do vídeo.",
@@ -57,11 +232,7 @@ async def transcribe_media(message: types.Message, bot: Bot, media_type: str, fi
         }
 
         error_msg = error_messages.get(media_type, "❌ Não foi possível transcrever o arquivo.")
-        await processing_message.edit_text(error_msg)
-    finally:
-        # Clean up the downloaded file
-        if os.path.exists(file_name):
-            os.remove(file_name)
+        await job.finish(error_msg)
 
 
 async def send_image_with_button(message: types.Message, query: str):
@@ -74,7 +245,7 @@ async def send_image_with_button(message: types.Message, query: str):
     """
     searching_message = await message.answer(f"🔍 Procurando imagem de: {query}")
     try:
-        image_url = GOOGLE_IMAGE_API.get_image(query)
+        image_url = await GOOGLE_IMAGE_API.aget_image(query)
         if image_url:
             # Create inline keyboard with "Pedir outra?" button
             builder = InlineKeyboardBuilder()
@@ -122,210 +293,191 @@ def is_valid_link(link: str) -> bool:
             return True
     return False
 
-async def send_media_stream(message: types.Message, force_download=False) -> dict:
-    """
-    Extrai a URL do vídeo de um link do YouTube ou de um vídeo do Facebook.
-    """
-    error_check = False
-    download = True if force_download else False
-    ydl_opts = {
+# Ways to send a link, in the order they are tried: the stream URL (no
+# bandwidth on our side), a looser format, then downloading and uploading
+# the file. The one that works is remembered per site, so later links from
+# it skip the attempts that fail there.
+MEDIA_ATTEMPTS = {
+    "stream": ('best[height<=720][ext=mp4]/best[height<=720]/best[ext=mp4]/best', False),
+    "stream_alt": ('best[ext=mp4]/best[ext=webm]/best', False),
+    "download": ('best[filesize<50M][height<=720][ext=mp4]/best[filesize<50M][ext=mp4]/best[height<=720][ext=mp4]/best[ext=mp4]/best', True),
+    "download_alt": ('best[ext=mp4]/best[ext=webm]/best', True),
+}
+
+
+def _media_opts(video_format: str) -> dict:
+    return {
         'quiet': True,
         'no_warnings': True,
-        'format': 'best[height<=720][ext=mp4]/best[height<=720]/best[ext=mp4]/best',
+        'format': video_format,
         'postprocessor_args': [
             '-movflags', '+faststart',
         ],
-        'get_url': True,
         'cookiefile': 'cookies.txt'
     }
-    if download:
-        ydl_opts["format"] = 'best[filesize<50M][height<=720][ext=mp4]/best[filesize<50M][ext=mp4]/best[height<=720][ext=mp4]/best[ext=mp4]/best'
 
+
+def _media_caption(message: types.Message, title: str) -> str:
+    sender = message.from_user.username or message.from_user.id if message.from_user else "Unknown"
+    return f'***{title}***\n\nLink: {message.text}\nEnviado por: {sender}'
+
+
+def _sent_media(sent: types.Message, title: str) -> Optional[dict]:
+    """What is needed to send the same file again: file_id, file_unique_id, kind and title."""
+    # Telegram turns short silent clips into animations
+    for kind in ("video", "animation"):
+        media = getattr(sent, kind, None)
+        if media is not None:
+            return {"file_id": media.file_id, "file_unique_id": media.file_unique_id, "kind": kind, "title": title}
+    return None
+
+
+async def send_known_media(message: types.Message, media: dict) -> bool:
+    """
+    Send a file the bot sent before, by its Telegram file_id (no download, no upload).
+
+    Returns False when Telegram refuses the file_id (a bad request), so the
+    caller can forget it and fetch the link again. Other Telegram errors are
+    raised: the file_id may still be good.
+    """
+    send = message.reply_animation if media["kind"] == "animation" else message.reply_video
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(message.text, download=download)
-            if not info.get("url") and not info.get("formats"):
-                resource_id = message.text.split("/")[-1]
-                raise ExtractorError(
-                    f"[{info.get('extractor', 'generic')}] {resource_id}: No video could be found",
-                    expected=True
-                )
-            if "instagram" in message.text:
-                for f in info["formats"]:
-                    if list(f.keys())[0] == "url":
-                        custom_url = f["url"]
-
-            if download:
-                video_file = ydl.prepare_filename(info)
-                with open(video_file, 'rb') as video:
-                    sender = message.from_user.username or message.from_user.id if message.from_user else "Unknown"
-                    caption = f'***{info.get("title")}***\n\nLink: {message.text}\nEnviado por: {sender}'
-                    await message.reply_video(
-                        video=types.FSInputFile(video_file),
-                        caption=caption,
-                        parse_mode="Markdown"
-                    )
-                os.remove(video_file)
-                return
-
-            video_data = {
-                "url": info.get('url'),
-                "title": info.get('title'),
-                "description": info.get('description')
-            }
-            sender = message.from_user.username or message.from_user.id if message.from_user else "Unknown"
-            caption = f'***{video_data["title"]}***\n\nLink: {message.text}\nEnviado por: {sender}'
-            await message.reply_video(
-                video=video_data["url"],
+        await send(media["file_id"], caption=_media_caption(message, media["title"]), parse_mode="Markdown")
+        return True
+    except TelegramBadRequest as e:
+        logging.error(f"Could not resend {media['file_id']} for {message.text}: {e}")
+        return False
+
+
+async def _send_media(message: types.Message, video_format: str, download: bool) -> Optional[dict]:
+    """Extract (and, if download, fetch) the video behind message.text, reply with it and return _sent_media()."""
+    info = await EXTRACTOR.extract_info(message.text, _media_opts(video_format), download=download)
+    if not info.get("url") and not info.get("formats"):
+        resource_id = message.text.split("/")[-1]
+        raise ExtractorError(
+            f"[{info.get('extractor', 'generic')}] {resource_id}: No video could be found",
+            expected=True
+        )
+
+    caption = _media_caption(message, info.get("title"))
+    if download:
+        video_file = info["_filename"]
+        try:
+            sent = await message.reply_video(
+                video=types.FSInputFile(video_file),
                 caption=caption,
                 parse_mode="Markdown"
             )
-    except ExtractorError as e:
-        if "Requested format is not available" in str(e) or "format" in str(e).lower():
-            # If the preferred format is not available, try with a more flexible format
-            ydl_opts_alt = {
-                'quiet': True,
-                'no_warnings': True,
-                'format': 'best[ext=mp4]/best[ext=webm]/best',
-                'postprocessor_args': [
-                    '-movflags', '+faststart',
-                ],
-                'get_url': True,
-                'cookiefile': 'cookies.txt'
-            }
-            try:
-                with YoutubeDL(ydl_opts_alt) as ydl:
-                    info = ydl.extract_info(message.text, download=download)
-                    if download:
-                        video_file = ydl.prepare_filename(info)
-                        with open(video_file, 'rb') as video:
-                            sender = message.from_user.username or message.from_user.id if message.from_user else "Unknown"
-                            caption = f'***{info.get("title")}***\n\nLink: {message.text}\nEnviado por: {sender}'
-                            await message.reply_video(
-                                video=types.FSInputFile(video_file),
-                                caption=caption,
-                                parse_mode="Markdown"
-                            )
-                        os.remove(video_file)
-                        return
-
-                    video_data = {
-                        "url": info.get('url'),
-                        "title": info.get('title'),
-                        "description": info.get('description')
-                    }
-                    sender = message.from_user.username or message.from_user.id if message.from_user else "Unknown"
-                    caption = f'***{video_data["title"]}***\n\nLink: {message.text}\nEnviado por: {sender}'
-                    await message.reply_video(
-                        video=video_data["url"],
-                        caption=caption,
-                        parse_mode="Markdown"
-                    )
-            except Exception as e_alt:
-                raise VideoNotFound(f"❌ Ocorreu um erro ao processar o vídeo mesmo com formato alternativo. {e_alt}")
-        else:
-            raise VideoNotFound(f"❌ Ocorreu um erro ao processar o vídeo. {e}")
-    except (ExtractorError, DownloadError) as e:
-        raise VideoNotFound(f"❌ Ocorreu um erro ao processar o vídeo. {e}")
+        finally:
+            os.remove(video_file)
+    else:
+        sent = await message.reply_video(
+            video=info['url'],
+            caption=caption,
+            parse_mode="Markdown"
+        )
+    return _sent_media(sent, info.get("title"))
+
+
+async def send_media_stream(message: types.Message, force_download=False) -> Optional[dict]:
+    """
+    Extrai a URL do vídeo de um link do YouTube ou de um vídeo do Facebook.
 
-    except Exception as e:
-        if error_check:
+    Tries MEDIA_ATTEMPTS in order, starting from the one that last worked
+    for the link's site: a format error moves on to the looser format, a
+    stream URL Telegram refuses moves on to downloading. Returns the sent
+    file (see _sent_media), or None if nothing was sent. Raises
+    VideoNotFound when the link has no usable video.
+    """
+    remembered = await EXTRACTOR.known_format(message.text, "telegram")
+    if force_download:
+        attempt = "download"
+    elif remembered in MEDIA_ATTEMPTS:
+        attempt = remembered
+    else:
+        attempt = "stream"
+
+    while True:
+        video_format, download = MEDIA_ATTEMPTS[attempt]
+        try:
+            sent = await _send_media(message, video_format, download)
+        except (ExtractorError, DownloadError) as e:
+            if "format" in str(e).lower() and not attempt.endswith("_alt"):
+                # If the preferred format is not available, try with a more flexible format
+                attempt += "_alt"
+                continue
+            raise VideoNotFound(f"❌ Ocorreu um erro ao processar o vídeo. {e}")
+        except Exception as e:
+            if not download:
+                # Telegram could not fetch the stream URL: send the file itself
+                logging.info(f"Sending the stream of {message.text} failed ({e}), downloading it")
+                await EXTRACTOR.forget(message.text, _media_opts(video_format))
+                attempt = "download"
+                continue
             await message.reply(f"❌ Ocorreu um erro ao processar o vídeo. {e}")
-        error_check = True
-        await send_media_stream(message, force_download=True)
+            return None
+
+        if attempt != remembered:
+            await EXTRACTOR.remember_format(message.text, attempt, "telegram")
+        return sent
 
 
-async def process_youtube_video(youtube_url: str) -> str:
+async def transcribe_youtube_video(youtube_url: str, progress=None) -> str:
     """
-    Download YouTube video audio, transcribe it, and generate a summary.
+    Download a YouTube video's audio and transcribe it.
 
     Args:
         youtube_url: URL of the YouTube video
+        progress: Optional async callback called with a short status once the download is done
 
     Returns:
-        Summary of the video content
+        Transcription of the video
     """
-    from shared.ai_tools import GROQ_API
-    import tempfile
-    import uuid
-
     # Create a temporary file name
-    temp_filename = f"temp_audio_{uuid.uuid4().hex}.mp3"
+    temp_filename = os.path.join(SPOOL_DIR, f"temp_audio_{uuid.uuid4().hex}.opus")
 
-    try:
-        # Download only the audio from YouTube video
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'postprocessor_args': [
-                '-ar', '16000'
-            ],
-            'prefer_ffmpeg': True,
-            'keepvideo': False,
-            'outtmpl': temp_filename.replace('.mp3', ''),  # yt-dlp will add .mp3
-        }
+    # Download only the audio, as 16 kHz mono speech-quality Opus; Whisper
+    # resamples to 16 kHz anyway, so a 192 kbit/s mp3 was wasted upload
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'format': 'bestaudio/best',
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'opus',
+            'preferredquality': '32',
+        }],
+        'postprocessor_args': [
+            '-ar', '16000', '-ac', '1'
+        ],
+        'prefer_ffmpeg': True,
+        'keepvideo': False,
+        'outtmpl': temp_filename.replace('.opus', ''),  # yt-dlp will add .opus
+    }
 
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([youtube_url])
+    try:
+        try:
+            await EXTRACTOR.extract_info(youtube_url, ydl_opts, download=True)
+        except DownloadError as e:
+            if "Requested format is not available" not in str(e) and "format" not in str(e).lower():
+                raise
+            # No audio-only stream: take any format that carries audio, ffmpeg drops the video
+            await EXTRACTOR.extract_info(youtube_url, {**ydl_opts, 'format': 'bestaudio*/best*'}, download=True)
 
         # Check if the file was created
         if not os.path.exists(temp_filename):
             raise Exception("Failed to download audio file")
 
-        # Transcribe the audio
-        transcription = GROQ_API.transcribe_audio(temp_filename)
-
-        # Generate summary using GROQ API
-        summary_prompt = "Você é uma ferramenta de resumir e summarizar conteúdos, retorne o resumo do que foi dito nesse video.. seja breve mas consiso. Responda apenas em texto.. NOT ALLOWED MARKDOWN AND HTML"
-        summary = GROQ_API.chat(f"{summary_prompt}\n\n{transcription}")
-
-        return summary
-
-    except DownloadError as e:
-        if "Requested format is not available" in str(e) or "format" in str(e).lower():
-            # If the preferred format is not available, try with a more flexible format
-            ydl_opts_alt = {
-                'quiet': True,
-                'no_warnings': True,
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'postprocessor_args': [
-                    '-ar', '16000'
-                ],
-                'prefer_ffmpeg': True,
-                'keepvideo': False,
-                'outtmpl': temp_filename.replace('.mp3', ''),  # yt-dlp will add .mp3
-            }
-
-            with YoutubeDL(ydl_opts_alt) as ydl:
-                ydl.download([youtube_url])
-
-            # Check if the file was created
-            if not os.path.exists(temp_filename):
-                raise Exception("Failed to download audio file with alternative format")
-
-            # Transcribe the audio
-            transcription = GROQ_API.transcribe_audio(temp_filename)
-
-            # Generate summary using GROQ API
-            summary_prompt = "Você é uma ferramenta de resumir e summarizar conteúdos, retorne o resumo do que foi dito nesse video.. seja breve mas consiso. Responda apenas em texto.. NOT ALLOWED MARKDOWN AND HTML"
-            summary = GROQ_API.chat(f"{summary_prompt}\n\n{transcription}")
-
-            return summary
-        else:
-            raise e
+        if progress is not None:
+            await progress("✍️ Transcrevendo...")
+        return await GROQ_API.atranscribe_audio(temp_filename)
 
     finally:
         # Clean up the temporary file
         if os.path.exists(temp_filename):
             os.remove(temp_filename)
+
+
+def summarize_transcription(transcription: str):
+    """Stream a summary of a video transcription (async iterator of text pieces)."""
+    return LLM_ROUTER.astream_chat(f"{YOUTUBE_SUMMARY_PROMPT}\n\n{transcription}")
@@ -1,10 +1,17 @@
 from fastapi import FastAPI, Request
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 import uvicorn
+import json
 import os
+from datetime import datetime
+from typing import Optional
 from dotenv import load_dotenv
 from telegram import send_telegram_message, escape_markdown, send_telegram_image, send_or_edit_telegram_message
 from shared.ai_tools import GOOGLE_IMAGE_API
-from shared.database import History
+from shared.database import AsyncHistory, row_to_dict
+from shared.maintenance import MAINTENANCE_INTERVAL_HOURS, maintenance_loop
 import logging
 
 # Configurar logging
@@ -14,8 +21,16 @@ load_dotenv()
 
 app = FastAPI(title="Webhook Service")
 
-# Initialize the database
-history = History()
+# Initialize the database; calls run on a database thread, off the event loop
+history = AsyncHistory()
+# Largest page of messages one JSON request returns; use the cursor for more
+MAX_PAGE_SIZE = 1000
+
+@app.on_event("startup")
+async def start_maintenance():
+    """Schedule backups, archival and VACUUM/optimize of the shared database."""
+    if MAINTENANCE_INTERVAL_HOURS > 0:
+        asyncio.create_task(maintenance_loop(history.history, MAINTENANCE_INTERVAL_HOURS))
 
 @app.get("/")
 async def root():
@@ -36,19 +51,30 @@ async def save_message(request: Request):
         replied_to = data.get("replied_to")
         from_bot = data.get("from_bot", False)
         kind = data.get("kind")
-        
+        chat_id = data.get("chat_id")
+
         # Save to database with kind
-        message_id = history.save_message(user, message_id, text, replied_to, from_bot, kind)
+        message_id = await history.save_message(user, message_id, text, replied_to, from_bot, kind, chat_id)
         return {"status": "success", "message_id": message_id}
     except Exception as e:
         logging.error(f"Error saving message: {e}")
         return {"error": str(e)}
 
+@app.get("/messages/search")
+async def search_messages(q: str, user: Optional[str] = None, since: Optional[datetime] = None, limit: int = 20, chat_id: Optional[str] = None):
+    """Full-text search over message texts, best matches first."""
+    try:
+        results = await history.search(q, user=user, since=since, limit=limit, chat_id=chat_id)
+        return {"status": "success", "results": results}
+    except Exception as e:
+        logging.error(f"Error searching messages for {q!r}: {e}")
+        return {"error": str(e)}
+
 @app.get("/messages/{message_id}")
-async def get_message(message_id: str):
+async def get_message(message_id: str, chat_id: Optional[str] = None):
     """Retrieve a message by its ID."""
     try:
-        message = history.get_message(message_id)
+        message = await history.get_message(message_id, chat_id)
         if message:
             return {"status": "success", "message": message}
         else:
@@ -57,26 +83,61 @@ async def get_message(message_id: str):
         logging.error(f"Error retrieving message: {e}")
         return {"error": str(e)}
 
+async def ndjson_stream(chat_id: Optional[str], user: Optional[str], cursor: Optional[str], limit: Optional[int]):
+    """Yield messages as newline-delimited JSON, one batch in memory at a time."""
+    count = 0
+    async for row in history.iter_messages(user=user, cursor=cursor, chat_id=chat_id):
+        if limit is not None and count >= limit:
+            return
+        count += 1
+        yield json.dumps(row_to_dict(row), ensure_ascii=False) + "\n"
+
+async def list_messages(chat_id: Optional[str], user: Optional[str], cursor: Optional[str], limit: Optional[int], format: str):
+    """
+    Shared body of the listing endpoints.
+
+    format=json returns one page of up to MAX_PAGE_SIZE messages with a
+    next_cursor to pass back for the following page; format=ndjson streams
+    every matching row (or up to limit) without holding the response in
+    memory. Both return messages as column-name dicts.
+    """
+    if format == "ndjson":
+        return StreamingResponse(ndjson_stream(chat_id, user, cursor, limit), media_type="application/x-ndjson")
+
+    rows, next_cursor = await history.get_messages_page(user, cursor, min(limit or 100, MAX_PAGE_SIZE), chat_id)
+    return {"status": "success", "messages": [row_to_dict(row) for row in rows], "next_cursor": next_cursor}
+
 @app.get("/messages/user/{user}")
-async def get_messages_by_user(user: str, limit: int = 100):
-    """Retrieve messages sent by a specific user."""
+async def get_messages_by_user(user: str, limit: Optional[int] = None, cursor: Optional[str] = None, format: str = "json", chat_id: Optional[str] = None):
+    """Retrieve messages sent by a specific user, newest first."""
     try:
-        messages = history.get_messages_by_user(user, limit)
-        return {"status": "success", "messages": messages}
+        return await list_messages(chat_id, user, cursor, limit, format)
     except Exception as e:
         logging.error(f"Error retrieving messages for user {user}: {e}")
         return {"error": str(e)}
 
 @app.get("/messages")
-async def get_all_messages(limit: int = 100):
-    """Retrieve all messages, ordered by creation time."""
+async def get_all_messages(limit: Optional[int] = None, cursor: Optional[str] = None, format: str = "json", chat_id: Optional[str] = None):
+    """Retrieve all messages, newest first."""
     try:
-        messages = history.get_all_messages(limit)
-        return {"status": "success", "messages": messages}
+        return await list_messages(chat_id, None, cursor, limit, format)
     except Exception as e:
         logging.error(f"Error retrieving all messages: {e}")
         return {"error": str(e)}
 
+@app.get("/stats/activity")
+async def activity_stats(since: Optional[datetime] = None, until: Optional[datetime] = None, kind: Optional[str] = None, limit: int = 10, chat_id: Optional[str] = None, include_bots: bool = False):
+    """Per-user message and character totals from the daily rollups (default: this month, people only)."""
+    try:
+        if since is None:
+            since = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        rows = await history.get_activity(since, until, kind, limit, chat_id, include_bots)
+        activity = [{"user": user, "messages": messages, "characters": characters} for user, messages, characters in rows]
+        return {"status": "success", "activity": activity}
+    except Exception as e:
+        logging.error(f"Error retrieving activity stats: {e}")
+        return {"error": str(e)}
+
 @app.post("/steam/profiles")
 async def steam_profiles(request: Request):
     try:
@@ -84,19 +145,20 @@ async def steam_profiles(request: Request):
         data = await request.json()
         user, game = data.get("profile"), data.get("game")
         message = f"🎮 {user} is now playing {game}"
-        query_image = GOOGLE_IMAGE_API.get_image(f"Gameplay {game}")
+        query_image = await GOOGLE_IMAGE_API.aget_image(f"Gameplay {game}")
         send_telegram_image(
             os.getenv("TELEGRAM_BOT_TOKEN"),
             os.getenv("TELEGRAM_CHAT_ID"),
             image=query_image,
             caption=message
         )
-        history.save_message(
+        await history.save_message(
             user="steam_bot",
             from_bot=True,
             message_id=f"steam_event_{hash(message)}",  # Generate a unique ID
             text=message,
-            kind="steam_event"
+            kind="steam_event",
+            chat_id=os.getenv("TELEGRAM_CHAT_ID")
         )
     except Exception as e:
         print(f"Error receiving data: {e}")	
@@ -143,8 +205,10 @@ async def discord_voice_state(request: Request):
         if messages:
             final_message = "\n".join(messages)
             logging.info(f"Enviando/atualizando mensagem para Telegram: {final_message}")
-            # Use the new function that can edit existing messages
-            telegram_response = send_or_edit_telegram_message(
+            # Use the new function that can edit existing messages. It reads the
+            # history synchronously, so keep it off the event loop.
+            telegram_response = await run_in_threadpool(
+                send_or_edit_telegram_message,
                 os.getenv("TELEGRAM_BOT_TOKEN"),
                 os.getenv("TELEGRAM_CHAT_ID"),
                 final_message,
@@ -156,12 +220,13 @@ async def discord_voice_state(request: Request):
             else:
                 telegram_message_id = telegram_response.json()["result"]["message_id"]
             
-            history.save_message(
+            await history.save_message(
                 user="discord_bot",
                 from_bot=True,
                 message_id=telegram_message_id,
                 text=final_message,
-                kind="discord_event"
+                kind="discord_event",
+                chat_id=os.getenv("TELEGRAM_CHAT_ID")
             )
 
         return {"status": "ok"}
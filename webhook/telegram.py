@@ -8,54 +8,42 @@ import logging
 # Key for the single message (independent of channel)
 SINGLE_MESSAGE_KEY = "single_event_message"
 
-def get_message_id_from_db(message_key):
+# Shared history handle, reuses the process-wide SQLite connection
+history = History()
+
+def message_state_key(message_key, chat_id):
+    """State key holding the Telegram message ID for message_key in chat_id"""
+    return f"telegram_message:{message_key}:{chat_id}"
+
+def get_message_id_from_db(message_key, chat_id):
     """Get message ID from database using the message key"""
     try:
-        history = History()
-        # We'll use a special user identifier for system messages
-        # and store the message_key in the replied_to field
-        messages = history.get_messages_by_user("discord_bot", 100)
-        for message in messages:
-            # message format: (id, user, message_id, text, replied_to, from_bot, kind, created)
-            if message[4] == message_key and message[6] == "system_message":
-                return message[2]  # Return message_id
-        return None
+        return history.get_state(message_state_key(message_key, chat_id))
     except Exception as e:
         logging.error(f"Error retrieving message ID from database: {e}")
         return None
 
-def save_message_id_to_db(user, message_id, text, replied_to=None, from_bot=None, kind=None):
-    """Save message ID to database with the message key"""
+def save_message_id_to_db(user, message_id, text, replied_to=None, from_bot=None, kind=None, chat_id=None):
+    """Save the message to the history and remember its ID under the message key"""
     try:
-        history = History()
-        # We'll use a special user identifier for system messages
-        # and store the message_key in the replied_to field
+        # The message key travels in the replied_to field
         history.save_message(
             user=user,
             message_id=message_id,
             text=text,
             replied_to=replied_to,
             from_bot=from_bot,
-            kind=kind
+            kind=kind,
+            chat_id=None if chat_id is None else str(chat_id)
         )
+        if replied_to:
+            history.set_state(message_state_key(replied_to, chat_id), message_id)
     except Exception as e:
         logging.error(f"Error saving message ID to database: {e}")
 
-def get_last_discord_event_message():
-    """Get the last discord_event message from the database"""
-    try:
-        history = History()
-        # Get last 5 messages
-        messages = history.get_all_messages(3)
-        # Look for a message with kind="discord_event"
-        for message in messages:
-            # message format: (id, user, message_id, text, replied_to, from_bot, kind, created)
-            if message[6] == "discord_event":
-                return message[2]  # Return message_id
-        return None
-    except Exception as e:
-        print(f"Error retrieving last discord_event message: {e}")
-        return None
+def get_last_discord_event_message(chat_id, event_key=None):
+    """Get the ID of the message that holds the current discord events"""
+    return get_message_id_from_db(event_key or SINGLE_MESSAGE_KEY, chat_id)
 
 def escape_markdown(text):
     """
@@ -81,7 +69,7 @@ def send_or_edit_telegram_message(bot_token, chat_id, message, event_key=None, k
     """
     # If kind is "discord_event", try to edit the last discord_event message
     if kind == "discord_event":
-        last_message_id = get_last_discord_event_message()
+        last_message_id = get_last_discord_event_message(chat_id, event_key)
         logging.info(f"Last discord_event message ID: {last_message_id}")
         if last_message_id:
             logging.info(f"Editing message ID: {last_message_id}")
@@ -92,8 +80,13 @@ def send_or_edit_telegram_message(bot_token, chat_id, message, event_key=None, k
                 "text": message,
                 "parse_mode": "Markdown"
             }
-            return requests.post(url, json=payload)
-    
+            response = requests.post(url, json=payload)
+            if response.ok or "message is not modified" in response.text:
+                return response
+            # The stored message is gone (deleted, too old to edit...): forget it and send a new one
+            logging.warning(f"Could not edit message {last_message_id}: {response.text}")
+            history.delete_state(message_state_key(event_key or SINGLE_MESSAGE_KEY, chat_id))
+
     logging.info(f"Sending new message: {message}")
     return send_new_message(bot_token, chat_id, message, event_key or SINGLE_MESSAGE_KEY)
 
@@ -117,7 +110,8 @@ def send_new_message(bot_token, chat_id, message, message_key):
                 text=message,
                 replied_to=message_key,
                 from_bot=True,
-                kind="discord_event"
+                kind="discord_event",
+                chat_id=chat_id
             )
     
     return response.json()